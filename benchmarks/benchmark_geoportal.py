@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import itertools
+import threading
+import subprocess
+import tempfile
+import multiprocessing
+import numpy as np
+
+# Offline throughput benchmark of GeoportalAPI against fake_mapserver.
+#
+# Every scenario (method, area, lod, period count, workers, tile_aligned) runs
+# in a fresh process, so peak RSS belongs to that scenario only, while the
+# fake server runs in this process. Results are written as json, and with
+# --baseline every scenario is compared to the same scenario of an earlier run.
+#
+#   python benchmark_geoportal.py --out results.json
+#   python benchmark_geoportal.py --latency 0.1 --error-rate 0.02 --baseline results.json
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code')
+sys.path.insert(0, CODE_DIR)
+from fake_mapserver import FakeMapServer
+
+# Vilnius old town, lat lon
+CENTER = (54.6872, 25.2797)
+METHODS = ['get_map_from_center', 'generator', 'get_geoportal_lt_map']
+
+class TimedLimiter:
+  """
+  Wraps a rate limiter of HttpClient and adds time spent in acquire to the thread's wait.
+  """
+  def __init__(self, limiter, waits):
+      self.limiter = limiter
+      self.waits = waits
+
+  def acquire(self):
+      started = time.perf_counter()
+      sent_at = self.limiter.acquire()
+      self.waits.seconds = getattr(self.waits, 'seconds', 0.0) + time.perf_counter() - started
+      return sent_at
+
+  def __getattr__(self, name):
+      return getattr(self.limiter, name)
+
+
+class RecordingClient:
+  """
+  Wraps HttpClient and records latency and size of every image response.
+
+  Latency is the time of the request without waiting for the client side
+  rate limiter, which is recorded separately as limiter_seconds.
+  """
+  def __init__(self, client):
+      self.client = client
+      self.latencies = []
+      self.bytes = 0
+      self.limiter_seconds = 0.0
+      self.lock = threading.Lock()
+      self.waits = threading.local()
+      get_limiter = client.get_limiter
+      client.get_limiter = lambda url: TimedLimiter(get_limiter(url), self.waits)
+
+  def reset(self):
+      with self.lock:
+          self.latencies = []
+          self.bytes = 0
+          self.limiter_seconds = 0.0
+
+  def get(self, url, params = None, **kwargs):
+      self.waits.seconds = 0.0
+      started = time.perf_counter()
+      response = self.client.get(url, params=params, **kwargs)
+      seconds = time.perf_counter() - started
+      if '/export' in url or '/tile/' in url:
+          with self.lock:
+              self.latencies.append(seconds - self.waits.seconds)
+              self.limiter_seconds += self.waits.seconds
+              self.bytes += len(response.content)
+      return response
+
+def get_peak_rss_mb():
+    # ru_maxrss survives exec on Linux, so a spawned process would report the
+    # peak of its parent, VmHWM starts over with the new process
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def run_scenario(scenario, server_url, cache_dir, results):
+    import api_geoportal as ag
+    from http_session import HttpClient
+    from metrics import StageTotals
+    ag.CACHE_DIR = os.path.join(cache_dir, 'tiles')
+    ag.METADATA_DIR = os.path.join(cache_dir, 'metadata')
+    client = RecordingClient(HttpClient(backoff=0.01))
+    if scenario['method'] == 'get_geoportal_lt_map':
+        api = ag.get_api()
+        api.cache.clear()
+    else:
+        api = ag.GeoportalAPI(max_workers=scenario['workers'], image_format=scenario['format'])
+    api.http = client
+    for name in api.period:
+        api.period[name] = f'{server_url}/{name}/MapServer'
+    periods = api.get_period_names()[-scenario['periods']:]
+    lod = scenario['lod']
+    area = scenario['area']
+    x, y = ag.get_transformer().transform(*CENTER)
+    # Metadata requests are not part of the measurement
+    api.get_grid_info(periods, lod)
+    client.reset()
+    stages = api.metrics.subscribe(StageTotals()) if scenario['stages'] else None
+    rss_before = get_peak_rss_mb()
+
+    started = time.perf_counter()
+    if scenario['method'] == 'get_map_from_center':
+        map, _ = api.get_map_from_center(x, y, area, area, periods, lod, False, scenario['workers'], scenario['tile_aligned'])
+        pixels = map.shape[0] * map.shape[1] * map.shape[2]
+    elif scenario['method'] == 'generator':
+        rows, _, _ = api.get_map_from_center_generator(x, y, area, area, periods, lod, False, scenario['workers'], scenario['tile_aligned'])
+        pixels = sum(tile.shape[0] * tile.shape[1] * tile.shape[2] for row in rows for tile in row)
+    else:
+        resolution = {level: name for name, level in ag.resolutions_dict.items()}[lod]
+        map = ag.get_geoportal_lt_map(CENTER[0], CENTER[1], area, resolution, periods[0])
+        pixels = map.shape[0] * map.shape[1]
+    seconds = time.perf_counter() - started
+
+    latencies = np.array(client.latencies) * 1000
+    results.put({
+        'seconds': seconds,
+        'pixels': pixels,
+        'tiles': len(latencies),
+        'bytes': client.bytes,
+        'tiles_per_s': len(latencies) / seconds,
+        'mb_per_s': client.bytes / seconds / 1e6,
+        'mpixels_per_s': pixels / seconds / 1e6,
+        'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'retries': client.client.retries,
+        'limiter_seconds': client.limiter_seconds,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'start_rss_mb': rss_before,
+        'stages': stages.get_summary() if stages is not None else None
+    })
+
+def get_scenarios(args):
+    scenarios = []
+    for method, area, lod, periods, workers, tile_aligned in itertools.product(args.methods, args.areas, args.lods, args.periods, args.workers, args.tile_aligned):
+        if method == 'get_geoportal_lt_map':
+            # It takes one period and uses the shared api settings, so it runs once per area and lod
+            if (periods, workers, tile_aligned) != (args.periods[0], args.workers[0], args.tile_aligned[0]):
+                continue
+            periods, workers, tile_aligned = 1, 1, False
+        scenarios.append({'method': method, 'area': area, 'lod': lod, 'periods': periods, 'workers': workers, 'tile_aligned': tile_aligned, 'format': args.format, 'stages': args.stages})
+    return scenarios
+
+def get_scenario_key(scenario):
+    return json.dumps({name: scenario[name] for name in ('method', 'area', 'lod', 'periods', 'workers', 'tile_aligned', 'format')}, sort_keys=True)
+
+def get_git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=CODE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args):
+    server = FakeMapServer(0, args.latency, args.jitter, args.bandwidth, args.error_rate, args.max_image_size, args.tile_size).start()
+    context = multiprocessing.get_context('spawn')
+    scenarios = get_scenarios(args)
+    output = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': get_git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'server': {'latency': args.latency, 'jitter': args.jitter, 'bandwidth': args.bandwidth, 'error_rate': args.error_rate,
+                       'max_image_size': args.max_image_size, 'tile_size': args.tile_size},
+            'repeat': args.repeat
+        },
+        'results': []
+    }
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for i, scenario in enumerate(scenarios):
+            runs = []
+            for _ in range(args.repeat):
+                results = context.Queue()
+                process = context.Process(target=run_scenario, args=(scenario, server.url, cache_dir, results))
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError(f"Scenario {scenario} failed with exit code {process.exitcode}")
+                runs.append(results.get())
+            # Metrics of the run with median time
+            runs.sort(key=lambda run: run['seconds'])
+            result = {**scenario, **runs[len(runs) // 2], 'runs_seconds': [run['seconds'] for run in runs]}
+            output['results'].append(result)
+            print(f"{i + 1:3d}/{len(scenarios):3d} {scenario['method']:22s} area {scenario['area']:6g} lod {scenario['lod']:2d} periods {scenario['periods']} workers {scenario['workers']:2d} tiles {int(scenario['tile_aligned'])} | "
+                  f"{result['seconds']:7.2f} s | {result['tiles_per_s']:7.1f} tiles/s | {result['mb_per_s']:6.2f} MB/s | p50 {result['latency_p50_ms'] or 0:6.1f} ms | p99 {result['latency_p99_ms'] or 0:6.1f} ms | {result['peak_rss_mb']:6.0f} MB", file=sys.stderr)
+    server.stop()
+    return output
+
+def compare(output, baseline):
+    """
+    Adds speedup (baseline seconds / seconds) to results that have a matching baseline scenario.
+    """
+    baseline_results = {get_scenario_key(result): result for result in baseline['results']}
+    for result in output['results']:
+        previous = baseline_results.get(get_scenario_key(result))
+        if previous is not None:
+            result['baseline_seconds'] = previous['seconds']
+            result['speedup'] = previous['seconds'] / result['seconds']
+            print(f"{result['method']:22s} area {result['area']:6g} lod {result['lod']:2d} periods {result['periods']} workers {result['workers']:2d} tiles {int(result['tile_aligned'])} | speedup {result['speedup']:5.2f}x", file=sys.stderr)
+    output['meta']['baseline'] = baseline['meta']
+    return output
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GeoportalAPI against a local fake MapServer.')
+    parser.add_argument('--methods', nargs='+', default=METHODS, choices=METHODS)
+    parser.add_argument('--areas', type=float, nargs='+', default=[100, 500], help='area sides in meters')
+    parser.add_argument('--lods', type=int, nargs='+', default=[10, 12])
+    parser.add_argument('--periods', type=int, nargs='+', default=[1, 3], help='numbers of periods')
+    parser.add_argument('--workers', type=int, nargs='+', default=[8], help='requests in flight')
+    parser.add_argument('--tile-aligned', type=int, nargs='+', default=[0, 1], choices=[0, 1], help='0 for export renders, 1 for cached tiles')
+    parser.add_argument('--format', default='png', help='export image format')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.05, help='server seconds before every response')
+    parser.add_argument('--jitter', type=float, default=0.02, help='extra random server latency in seconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='server bytes per second per connection')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of image requests answered with 503')
+    parser.add_argument('--max-image-size', type=int, default=2048, help='maxImageWidth and maxImageHeight of the server')
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--stages', action='store_true', help='also record time per stage (http, decode, standardize, copy), adds a little overhead')
+    parser.add_argument('--out', default=None, help='result json, printed if not given')
+    parser.add_argument('--baseline', default=None, help='result json of an earlier run to compare with')
+    args = parser.parse_args()
+    args.tile_aligned = [bool(value) for value in args.tile_aligned]
+
+    output = run_benchmark(args)
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf8') as f:
+            output = compare(output, json.load(f))
+    if args.out is None:
+        print(json.dumps(output, indent=2))
+    else:
+        with open(args.out, 'w', encoding='utf8') as f:
+            json.dump(output, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import numpy as np
+from PIL import Image
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the geoportal.lt ArcGIS MapServer services.
+#
+# Every /<anything>/MapServer path is a service with the same metadata:
+#   ?f=json                    - tileInfo (origin, tile size, lods), maxImageWidth/Height
+#   /export?bbox=&size=&format= - synthetic image of the bbox (png, png8, png24, png32, jpg)
+#   /tile/{level}/{row}/{col}   - synthetic PNG tile of the tile grid
+# Pixels are a function of their EPSG:3346 coordinates, so exports and tiles
+# of the same place agree. Latency, bandwidth and errors are configurable.
+
+# Resolutions of levels in meters per pixel, the same levels as api_geoportal.resolutions_dict
+LEVELS = {1: 529.1677250021168, 2: 264.5838625010584, 3: 132.2919312505292, 4: 66.1459656252646,
+          5: 26.458386250105836, 6: 13.229193125052918, 7: 6.614596562526459, 8: 2.6458386250105836,
+          9: 1.3229193125052918, 10: 0.5291677250021167, 11: 0.26458386250105836, 12: 0.13229193125052918}
+METERS_PER_POINT = 0.00026458386250105836
+
+def get_service_info(max_image_size = 2048, tile_size = 256):
+    lods = [{'level': level, 'resolution': resolution, 'scale': resolution / METERS_PER_POINT} for level, resolution in LEVELS.items()]
+    return {
+        'maxImageWidth': max_image_size,
+        'maxImageHeight': max_image_size,
+        'tileInfo': {'rows': tile_size, 'cols': tile_size, 'origin': {'x': -5122000, 'y': 10000100}, 'lods': lods, 'format': 'PNG'}
+    }
+
+def render(x_left, y_top, resolution, width, height):
+    """
+    Synthetic imagery: colour gradients of the coordinates with a little texture.
+    """
+    xs = x_left + (np.arange(width) + 0.5) * resolution
+    ys = y_top - (np.arange(height) + 0.5) * resolution
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = (np.floor(xs * 3) % 256)[np.newaxis, :]
+    image[..., 1] = (np.floor(ys * 3) % 256)[:, np.newaxis]
+    image[..., 2] = ((np.floor(xs)[np.newaxis, :] * 7 + np.floor(ys)[:, np.newaxis] * 13) % 64 + 96).astype(np.uint8)
+    return image
+
+def encode(image, image_format):
+    buffer = io.BytesIO()
+    im = Image.fromarray(image)
+    if image_format == 'jpg':
+        im.save(buffer, 'JPEG', quality=75)
+        return buffer.getvalue(), 'image/jpeg'
+    if image_format == 'png8':
+        im = im.quantize(256)
+    elif image_format == 'png32':
+        im = im.convert('RGBA')
+    im.save(buffer, 'PNG', compress_level=1)
+    return buffer.getvalue(), 'image/png'
+
+class FakeMapServer:
+  """
+  Threaded HTTP server answering MapServer requests.
+
+  Every response waits latency seconds (plus uniform jitter up to jitter
+  seconds), bodies are sent at bandwidth bytes per second per connection
+  (unlimited if None) and error_rate of image requests get a 503 response.
+  """
+  def __init__(self, port = 0, latency = 0.0, jitter = 0.0, bandwidth = None, error_rate = 0.0, max_image_size = 2048, tile_size = 256, seed = 0):
+      self.latency = latency
+      self.jitter = jitter
+      self.bandwidth = bandwidth
+      self.error_rate = error_rate
+      self.info = get_service_info(max_image_size, tile_size)
+      self.random = random.Random(seed)
+      self.lock = threading.Lock()
+      self.requests = 0
+      self.errors = 0
+      self.server = ThreadingHTTPServer(('127.0.0.1', port), self.__make_handler())
+      self.server.daemon_threads = True
+      self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+  def __make_handler(self):
+      server = self
+      class Handler(BaseHTTPRequestHandler):
+          protocol_version = 'HTTP/1.1'
+          # Headers and body are separate writes on keep-alive connections,
+          # with Nagle and delayed ACK every pooled request would wait ~40 ms
+          disable_nagle_algorithm = True
+          def log_message(self, *args):
+              pass
+          def do_GET(self):
+              server.handle(self)
+      return Handler
+
+  def start(self):
+      threading.Thread(target=self.server.serve_forever, daemon=True).start()
+      return self
+
+  def stop(self):
+      self.server.shutdown()
+      self.server.server_close()
+
+  def get_service_url(self, name):
+      return f'{self.url}/{name}/MapServer'
+
+  def __draw(self):
+      with self.lock:
+          self.requests += 1
+          failed = self.random.random() < self.error_rate
+          if failed:
+              self.errors += 1
+          return self.random.uniform(0, self.jitter), failed
+
+  def __send(self, handler, status, body, content_type, headers = {}):
+      handler.send_response(status)
+      handler.send_header('Content-Type', content_type)
+      handler.send_header('Content-Length', str(len(body)))
+      for name, value in headers.items():
+          handler.send_header(name, value)
+      handler.end_headers()
+      if self.bandwidth is None:
+          handler.wfile.write(body)
+          return
+      step = 64 * 1024
+      for start in range(0, len(body), step):
+          handler.wfile.write(body[start:start + step])
+          time.sleep(min(step, len(body) - start) / self.bandwidth)
+
+  def handle(self, handler):
+      jitter, failed = self.__draw()
+      time.sleep(self.latency + jitter)
+      url = urlparse(handler.path)
+      query = {name: values[0] for name, values in parse_qs(url.query).items()}
+      if url.path.endswith('/MapServer'):
+          return self.__send(handler, 200, json.dumps(self.info).encode('utf8'), 'application/json')
+      if not (url.path.endswith('/export') or '/tile/' in url.path):
+          return self.__send(handler, 404, b'{"error": {"code": 404}}', 'application/json')
+      if failed:
+          return self.__send(handler, 503, b'{"error": {"code": 503}}', 'application/json', {'Retry-After': '0'})
+      if url.path.endswith('/export'):
+          x_left, y_bottom, x_right, y_top = map(float, query['bbox'].split(','))
+          width, height = map(int, query['size'].split(','))
+          image = render(x_left, y_top, (x_right - x_left) / width, width, height)
+          body, content_type = encode(image, query.get('format', 'png'))
+      else:
+          level, row, col = map(int, url.path.split('/tile/')[1].split('/'))
+          tile_info = self.info['tileInfo']
+          resolution = LEVELS[level]
+          x_left = tile_info['origin']['x'] + col * tile_info['cols'] * resolution
+          y_top = tile_info['origin']['y'] - row * tile_info['rows'] * resolution
+          body, content_type = encode(render(x_left, y_top, resolution, tile_info['cols'], tile_info['rows']), 'png')
+      self.__send(handler, 200, body, content_type)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local fake geoportal.lt MapServer.')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random latency in seconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second per connection')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of image requests answered with 503')
+    args = parser.parse_args()
+    server = FakeMapServer(args.port, args.latency, args.jitter, args.bandwidth, args.error_rate)
+    print(f"Serving {server.get_service_url('<name>')}", file=sys.stderr)
+    server.server.serve_forever()
+
+if __name__ == '__main__':
+    main()
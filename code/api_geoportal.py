@@ -1,13 +1,32 @@
 import numpy as np
 import requests
+import http_session
 from PIL import Image
 import io
+import os
 import math
-from pyproj import Transformer
+import time
+import json
+import hashlib
+import itertools
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tile_cache import TileCache
+from file_utils import write_atomic
+from metrics import Metrics
+from raster_store import RasterStore
+from spatial_index import deduplicate, group_points
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'geoportal_lt', 'tiles')
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+METADATA_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'geoportal_lt', 'metadata')
+METADATA_TTL = 7 * 24 * 60 * 60
 
 class EPSG4326_TO_EPSG3346:
   def __init__(self):
-    self.transformer = Transformer.from_crs("EPSG:4326", "EPSG:3346", always_xy=True)
+    # pyproj is imported and set up on first use, it is slow to start
+    self.transformer = None
 
   def transform(self, lat, lon):
     """
@@ -24,25 +43,26 @@ class EPSG4326_TO_EPSG3346:
     Returns:
       Transformed coordinates.
     """
+    if self.transformer is None:
+      from pyproj import Transformer
+      self.transformer = Transformer.from_crs("EPSG:4326", "EPSG:3346", always_xy=True)
     return self.transformer.transform(lon, lat)
 
-transformer = EPSG4326_TO_EPSG3346()
+def standardize_rgb(rgb_matrix, dtype = float):
+    # Standardize each channel separately with the statistics of this matrix only,
+    # see normalization.py for statistics shared by the whole mosaic
+    rgb_matrix = rgb_matrix.astype(dtype)
+    mean = rgb_matrix.mean(axis=(0, 1))
+    std = rgb_matrix.std(axis=(0, 1))
+    rgb_matrix -= mean
+    rgb_matrix /= std
+    rgb_matrix += 1
+    rgb_matrix /= 2
+    return rgb_matrix
 
-def standardize_rgb(rgb_matrix):
-    # Ensure the input is float type for calculations
-    rgb_matrix = rgb_matrix.astype(float)
-
-    # Standardize each channel separately
-    for channel in range(3):  # 0 for R, 1 for G, 2 for B
-        channel_values = rgb_matrix[:,:,channel]
-        mean = np.mean(channel_values)
-        std = np.std(channel_values)
-        rgb_matrix[:,:,channel] = (channel_values - mean) / std
-        
-    return (rgb_matrix + 1) / 2
-        
 def meaters_to_pixels(meaters, resolution):
-    pixels = math.ceil(meaters / resolution)
+    # Rounding keeps exact multiples of resolution from gaining an extra pixel
+    pixels = math.ceil(round(meaters / resolution, 6))
     return pixels
 
 def pixels_to_meaters(pixels, resolution):
@@ -65,20 +85,132 @@ def devide_into_parts_xy(x, y, width, height, max_width, max_height):
     res = [[{'x': x_part[0], 'y': y_part[0], 'width': x_part[1], 'height': y_part[1]} for x_part in x_parts] for y_part in y_parts]
     return res, (len(x_parts), len(y_parts))
         
-def get_params(x, y, width, height, resolution, max_px_width, max_px_height, scale):
+def get_params(x, y, width, height, resolution, max_px_width, max_px_height, scale, image_format = 'png'):
     parts, dims = devide_into_parts_xy(x, y, width, height, pixels_to_meaters(max_px_width, resolution), pixels_to_meaters(max_px_height, resolution))
     return [[{
         'bbox': f'{part["x"]},{part["y"]},{part["x"]+part["width"]},{part["y"]+part["height"]}',
-        'format': 'png',
+        'format': image_format,
         'transparent': 'false',
         'f': 'image',
         'mapScale': f'{scale}',
         'size': f'{meaters_to_pixels(part["width"], resolution)},{meaters_to_pixels(part["height"], resolution)}',
     } for part in x_parts] for x_parts in parts], dims, (meaters_to_pixels(width, resolution), meaters_to_pixels(height, resolution))
 
+def decode_image(data, out = None):
+    """
+    Decodes PNG or JPEG bytes into an uint8 RGB array.
+
+    Paletted images (png8) are expanded with a palette lookup and RGBA
+    images (png32) are sliced, instead of converting the PIL image first.
+    PIL decodes into its own buffer, so with out the pixels are copied once
+    more (except paletted images, whose lookup writes straight into out).
+
+    Args:
+      data: Encoded image.
+      out: Optional uint8 array of shape (H, W, 3) to write the image into, e.g. a slice of a mosaic.
+
+    Returns:
+      Decoded image (out if given).
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.mode == 'P':
+        palette = np.array(img.getpalette('RGB'), dtype=np.uint8).reshape(-1, 3)
+        index = np.asarray(img)
+        if out is None:
+            return palette[index]
+        np.take(palette, index, axis=0, out=out, mode='clip')
+        return out
+    if img.mode == 'RGB':
+        rgb = np.asarray(img)
+    elif img.mode in ('RGBA', 'RGBX'):
+        rgb = np.asarray(img)[:, :, :3]
+    else:
+        rgb = np.asarray(img.convert('RGB'))
+    if out is None:
+        return rgb
+    out[...] = rgb
+    return out
+
+def get_tile_params(x, y, width, height, resolution, tile_info):
+    """
+    Finds the tiles of MapServer cache grid that cover the area.
+
+    The area is snapped to the pixel grid of the level, so it can be shifted by
+    less than one pixel compared to an export request of the same area.
+
+    Args:
+      x: x coordinate of bottom left corner in EPSG3346.
+      y: y coordinate of bottom left corner in EPSG3346.
+      width: Width of area in meters.
+      height: Height of area in meters.
+      resolution: Resolution of level in meters per pixel.
+      tile_info: 'tileInfo' part of MapServer metadata.
+
+    Returns:
+      Rows (top to bottom) of tiles with crop window in tile pixels, dims and dims_pixel as in get_params.
+    """
+    width_px = meaters_to_pixels(width, resolution)
+    height_px = meaters_to_pixels(height, resolution)
+    left = math.floor(round((x - tile_info['origin']['x']) / resolution, 6))
+    top = math.floor(round((tile_info['origin']['y'] - (y + height)) / resolution, 6))
+    tile_width = tile_info['cols']
+    tile_height = tile_info['rows']
+    def parts(start, length, tile_size):
+        return [(i, max(start, i * tile_size) - i * tile_size, min(start + length, (i + 1) * tile_size) - i * tile_size)
+                for i in range(start // tile_size, (start + length - 1) // tile_size + 1)]
+    x_parts = parts(left, width_px, tile_width)
+    y_parts = parts(top, height_px, tile_height)
+    return [[{
+        'row': row,
+        'col': col,
+        'crop': (top_px, bottom_px, left_px, right_px),
+        'size': f'{right_px - left_px},{bottom_px - top_px}',
+    } for col, left_px, right_px in x_parts] for row, top_px, bottom_px in y_parts], (len(x_parts), len(y_parts)), (width_px, height_px)
+
+def get_tile_slices(params):
+    """
+    Yields (row slice, column slice) of every part of params (rows top to bottom) in the mosaic.
+    """
+    top = 0
+    for x_params in params:
+        left = 0
+        for param in x_params:
+            width, height = map(int, param['size'].split(','))
+            yield (slice(top, top + height), slice(left, left + width)), param
+            left += width
+        top += height
+
+def ordered_concurrent_map(func, iterable, max_workers = 1):
+    """
+    Applies func to every item of iterable using a pool of threads.
+
+    At most max_workers calls are in flight at any time and results are
+    yielded in the same order as the items of iterable.
+
+    Args:
+      func: Function of one argument.
+      iterable: Items to apply func to.
+      max_workers: Maximum number of concurrent calls. 1 means no threads.
+
+    Returns:
+      Generator of results.
+    """
+    if max_workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for item in iterable:
+            if len(futures) >= max_workers:
+                yield futures.popleft().result()
+            futures.append(executor.submit(func, item))
+        while futures:
+            yield futures.popleft().result()
+
 
 class GeoportalAPI:
-  def __init__(self):
+  def __init__(self, max_workers = 1, cache = None, http = None, image_format = 'png', metadata_dir = None, metadata_ttl = METADATA_TTL, metrics = None):
       self.period = {
           '1995-1999': 'https://www.geoportal.lt/arcgis/rest/services/NZT/ORT10LT_1995_2001/MapServer',
           '2005-2006': 'https://www.geoportal.lt/arcgis/rest/services/NZT/ORT10LT_2005_2006/MapServer',
@@ -90,15 +222,52 @@ class GeoportalAPI:
       }
       self.period_info = {}
       self.period_lods_info = {}
-      self.generator_log = {0: 0}
+      self.mosaic_ids = itertools.count(1)
+      self.max_workers = max_workers
+      self.cache = cache
+      self.http = http if http is not None else http_session.get_client()
+      # Export format: 'png' (default), 'png8', 'png24', 'png32' or 'jpg' (several times smaller, lossy)
+      self.image_format = image_format
+      # Service metadata (tileInfo, lods, maxImageWidth, ...) is kept on disk for metadata_ttl seconds
+      self.metadata_dir = metadata_dir
+      self.metadata_ttl = metadata_ttl
+      # Stage timings, bytes, cache hits and retries go to subscribers of metrics (see metrics.py)
+      self.metrics = metrics if metrics is not None else Metrics()
 
   def get_period_names(self):
       return list(self.period.keys())
 
+  def __get_metadata_path(self, url):
+      return os.path.join(self.metadata_dir, hashlib.sha256(url.encode('utf-8')).hexdigest()[:32] + '.json')
+
+  def __load_metadata(self, url):
+      if self.metadata_dir is None:
+          return None
+      try:
+          with open(self.__get_metadata_path(url), 'r', encoding='utf8') as f:
+              metadata = json.load(f)
+      except (FileNotFoundError, ValueError):
+          return None
+      if metadata.get('url') != url or time.time() - metadata['fetched_at'] > self.metadata_ttl:
+          return None
+      return metadata['info']
+
+  def __save_metadata(self, url, info):
+      if self.metadata_dir is None:
+          return
+      os.makedirs(self.metadata_dir, exist_ok=True)
+      metadata = {'url': url, 'fetched_at': time.time(), 'info': info}
+      write_atomic(self.__get_metadata_path(url), lambda f: json.dump(metadata, f))
+
   def get_period_info(self, period):
       if period not in self.period_info:
-          response = requests.get(f"{self.period[period]}?f=json")
-          self.period_info[period] = response.json()
+          url = self.period[period]
+          info = self.__load_metadata(url)
+          if info is None:
+              info = self.http.get(f"{url}?f=json").json()
+              if 'tileInfo' in info:
+                  self.__save_metadata(url, info)
+          self.period_info[period] = info
       return self.period_info[period]
 
   def get_period_lods_info(self, period):
@@ -106,76 +275,435 @@ class GeoportalAPI:
           self.period_lods_info[period] = {lod['level']: lod for lod in self.get_period_info(period)['tileInfo']['lods']}
       return self.period_lods_info[period]
 
-  def __get_map_from_bottom_left_corner(self, period, params, rgb_standardized):
+  def __get_image_bytes(self, url, params = None, missing_ok = False, **labels):
+      """
+      Returns image bytes of a MapServer request, None for a missing tile if missing_ok.
+
+      Failed requests (after retries) and MapServer json errors raise
+      requests.HTTPError, they are never decoded into a map.
+      """
+      metrics = self.metrics
+      key = None
+      if self.cache is not None:
+          key = self.cache.key(url, params)
+          data = self.cache.get(key)
+          if metrics.enabled:
+              metrics.emit('cache_hits' if data is not None else 'cache_misses', 1, **labels)
+          if data is not None:
+              return data
+      if metrics.enabled:
+          started = time.perf_counter()
+          response = self.http.get(url, params=params, on_retry=lambda attempt: metrics.emit('http_retries', 1, **labels))
+          metrics.emit('http_seconds', time.perf_counter() - started, **labels)
+          metrics.emit('http_bytes', len(response.content), **labels)
+      else:
+          response = self.http.get(url, params=params)
+      if missing_ok and response.status_code == 404:
+          return None
+      response.raise_for_status()
+      if not response.headers.get('Content-Type', '').startswith('image/'):
+          # MapServer reports errors as json with status 200
+          try:
+              code = response.json()['error']['code']
+          except (ValueError, KeyError, TypeError):
+              code = None
+          if missing_ok and code == 404:
+              return None
+          raise requests.HTTPError(f"MapServer returned {response.headers.get('Content-Type')} instead of an image (error code {code}) for {response.url}", response=response)
+      if key is not None:
+          self.cache.put(key, response.content)
+      return response.content
+
+  def __get_map_from_bottom_left_corner(self, period, params, rgb_standardized, out = None):
       """
       Get map from geoportal.lt
 
-      :param x: x coordinate of bottom left corner in EPSG3346
-      :param y: y coordinate of bottom left corner in EPSG3346
-      :param width: width of map in meters
-      :param height: height of map in meters
       :param period: period of map
-      :param lod: level of detail of map
+      :param params: export params of one part of the map (see get_params)
+      :param rgb_standardized: standardize map with standardize_rgb
+      :param out: optional (H, W, 3) array to write map into
 
       :return: map as numpy array
       """
-      response = requests.get(f"{self.period[period]}/export", params=params)
-      map_as_png = response.content
-      img = Image.open(io.BytesIO(map_as_png))
-      img = img.convert('RGB')
-      map_as_matrix = np.array(img)
+      map_as_bytes = self.__get_image_bytes(f"{self.period[period]}/export", params, period=period, kind='export')
+      timed = self.metrics.enabled
+      if timed: started = time.perf_counter()
+      if not rgb_standardized:
+        map_as_matrix = decode_image(map_as_bytes, out)
+        if timed: self.__emit_stage('decode_seconds', started, period, 'export')
+        return map_as_matrix
+      map_as_matrix = decode_image(map_as_bytes)
+      if timed: started = self.__emit_stage('decode_seconds', started, period, 'export')
+      map_as_matrix = standardize_rgb(map_as_matrix)
+      if timed: started = self.__emit_stage('standardize_seconds', started, period, 'export')
+      if out is None:
+        return map_as_matrix
+      out[...] = map_as_matrix
+      if timed: self.__emit_stage('copy_seconds', started, period, 'export')
+      return out
+
+  def __get_tile_map(self, period, lod, param, rgb_standardized, out = None):
+      url = f"{self.period[period]}/tile/{lod}/{param['row']}/{param['col']}"
+      tile_bytes = self.__get_image_bytes(url, missing_ok=True, period=period, kind='tile')
+      timed = self.metrics.enabled
+      if timed: started = time.perf_counter()
+      if tile_bytes is None:
+          # Tiles outside of the covered area are missing (404), export renders them white
+          tile_info = self.get_period_info(period)['tileInfo']
+          tile = np.full((tile_info['rows'], tile_info['cols'], 3), 255, dtype=np.uint8)
+      else:
+          tile = decode_image(tile_bytes)
+      if timed: started = self.__emit_stage('decode_seconds', started, period, 'tile')
+      top, bottom, left, right = param['crop']
+      map_as_matrix = tile[top:bottom, left:right]
       if rgb_standardized:
         map_as_matrix = standardize_rgb(map_as_matrix)
-      return map_as_matrix
-
-  def __print_progress(self, current, total, predicted_size, real_size):
-      progress = f"{current:5d}/{total:5d}"
-      pred_size = f"predicted size: {predicted_size:10s}"
-      real_sz = f"real size: {real_size:10s}"
-      progress_line = f"{progress} | {pred_size} | {real_sz}"
-      #print(progress_line)
-
-  def __get_map_from_bottom_left_corner_generator_x(self, period, params, gen_key, dims, rgb_standardized):
-      for param in params:
-          maps = []
-          for p in period:
-              map = self.__get_map_from_bottom_left_corner(p, param, rgb_standardized)
-              self.generator_log[gen_key] += 1
-              self.__print_progress(self.generator_log[gen_key], dims[0] * dims[1] * len(period), param['size'], str(map.shape))
-              maps.append(map)
+        if timed: started = self.__emit_stage('standardize_seconds', started, period, 'tile')
+      if out is None:
+        return map_as_matrix
+      out[...] = map_as_matrix
+      if timed: self.__emit_stage('copy_seconds', started, period, 'tile')
+      return out
+
+  def __emit_stage(self, name, started, period, kind):
+      now = time.perf_counter()
+      self.metrics.emit(name, now - started, period=period, kind=kind)
+      return now
+
+  def measure_image_formats(self, x, y, width, height, period, lod, image_formats = ('jpg', 'png8', 'png24', 'png32')):
+      """
+      Downloads one export of the area in every format, bypassing the cache.
+
+      :return: dict of format -> {'bytes', 'request_seconds', 'decode_seconds'}
+      """
+      period_lod_info = self.get_period_lods_info(period)[lod]
+      resolution = period_lod_info['resolution']
+      params = {
+          'bbox': f'{x},{y},{x + width},{y + height}',
+          'transparent': 'false',
+          'f': 'image',
+          'mapScale': f'{period_lod_info["scale"]}',
+          'size': f'{meaters_to_pixels(width, resolution)},{meaters_to_pixels(height, resolution)}',
+      }
+      res = {}
+      for image_format in image_formats:
+          started = time.perf_counter()
+          response = self.http.get(f"{self.period[period]}/export", params={**params, 'format': image_format})
+          downloaded = time.perf_counter()
+          response.raise_for_status()
+          decode_image(response.content)
+          res[image_format] = {
+              'bytes': len(response.content),
+              'request_seconds': downloaded - started,
+              'decode_seconds': time.perf_counter() - downloaded
+          }
+      return res
+
+  def __get_tiles(self, period, params, fetch, max_workers, out = None, mask = None, fill = np.uint8(255)):
+      # All (tile, period) requests are independent, so they are fetched as one
+      # flat stream in row-major order and regrouped per tile afterwards.
+      # With out, every tile is written into its slice of out as it is decoded,
+      # no per tile result outlives the copy.
+      # Tiles outside mask (see coverage_planner) are not requested, they are filled with fill.
+      slices = list(get_tile_slices(params))
+      covered = [True] * len(slices) if mask is None else np.asarray(mask).ravel().tolist()
+      if out is None:
+          jobs = ((p, param, None) for (_, param), keep in zip(slices, covered) if keep for p in period)
+      else:
+          jobs = ((p, param, out[tile_slice + (i,)]) for (tile_slice, param), keep in zip(slices, covered) if keep for i, p in enumerate(period))
+      maps = ordered_concurrent_map(lambda job: fetch(*job), jobs, max_workers)
+      for (tile_slice, param), keep in zip(slices, covered):
+          if keep:
+              yield param, [next(maps) for _ in period]
+          elif out is None:
+              width, height = map(int, param['size'].split(','))
+              yield param, [np.full((height, width, 3), fill) for _ in period]
+          else:
+              out[tile_slice] = fill
+              yield param, [out[tile_slice + (i,)] for i in range(len(period))]
+
+  def __log_tile(self, period, dims, mosaic, maps):
+      if self.metrics.enabled:
+          self.metrics.emit('tiles_done', len(maps), mosaic=mosaic, total=dims[0] * dims[1] * len(period))
+
+  def __get_map_from_bottom_left_corner_generator_x(self, period, tiles, row, mosaic, dims):
+      # Tiles come from the shared stream while the row is current and from
+      # the row's buffer once the generator has moved past it
+      while True:
+          if row['buffer'] is not None:
+              if not row['buffer']:
+                  return
+              param, maps = row['buffer'].popleft()
+          elif row['left']:
+              row['left'] -= 1
+              param, maps = next(tiles)
+          else:
+              return
+          self.__log_tile(period, dims, mosaic, maps)
           map = np.stack(maps, axis = 2)
           yield map
 
-  def __get_map_from_bottom_left_corner_generator_y(self, period, params, dims, rgb_standardized):
-      key = max(self.generator_log.keys()) + 1
-      self.generator_log[key] = 0
-      self.__print_progress(self.generator_log[key], dims[0] * dims[1] * len(period), "-", "-")
-      for x_param in params:
-          yield self.__get_map_from_bottom_left_corner_generator_x(period, x_param, key, dims, rgb_standardized)
+  def __get_map_from_bottom_left_corner_generator_y(self, period, params, dims, fetch, max_workers, mask, fill):
+      key = next(self.mosaic_ids)
+      tiles = self.__get_tiles(period, params, fetch, max_workers, mask=mask, fill=fill)
+      for x_params in params:
+          row = {'left': len(x_params), 'buffer': None}
+          yield self.__get_map_from_bottom_left_corner_generator_x(period, tiles, row, key, dims)
+          # Rows share one request stream, tiles the caller did not consume yet are kept for later
+          row['buffer'] = deque(next(tiles) for _ in range(row['left']))
+          row['left'] = 0
+
+  def get_grid_info(self, period, lod):
+      """
+      Returns pixel grid shared by all periods at lod.
+
+      Parts of a mosaic are cut once and requested for every period, so all
+      periods must have the same resolution at lod (and the same tile grid).
+      Largest export size is the smallest one of all periods.
 
-  def get_map_from_bottom_left_corner_generator(self, x, y, width, height, period, lod, rgb_standardized = True):
-      period_info = self.get_period_info(period[0]) # FIXME: look at all pertiods
+      :return: dict with resolution, scale, maxImageWidth, maxImageHeight and tileInfo
+      """
+      period_info = self.get_period_info(period[0])
       period_lod_info = self.get_period_lods_info(period[0])[lod]
-      params, dims, dims_pixel = get_params(x, y, width, height, period_lod_info['resolution'], period_info['maxImageWidth'], period_info['maxImageHeight'], period_lod_info['scale'])
-      return self.__get_map_from_bottom_left_corner_generator_y(period, params[::-1], dims, rgb_standardized), dims, dims_pixel
+      grid_info = {
+          'resolution': period_lod_info['resolution'],
+          'scale': period_lod_info['scale'],
+          'maxImageWidth': period_info['maxImageWidth'],
+          'maxImageHeight': period_info['maxImageHeight'],
+          'tileInfo': period_info['tileInfo']
+      }
+      for p in period[1:]:
+          period_info = self.get_period_info(p)
+          period_lod_info = self.get_period_lods_info(p).get(lod)
+          if period_lod_info is None or not math.isclose(period_lod_info['resolution'], grid_info['resolution'], rel_tol=1e-9):
+              raise ValueError(f"Period '{p}' has different resolution at lod {lod} than '{period[0]}'")
+          grid_info['maxImageWidth'] = min(grid_info['maxImageWidth'], period_info['maxImageWidth'])
+          grid_info['maxImageHeight'] = min(grid_info['maxImageHeight'], period_info['maxImageHeight'])
+      return grid_info
+
+  def __get_plan(self, x, y, width, height, period, lod, rgb_standardized, tile_aligned):
+      grid_info = self.get_grid_info(period, lod)
+      if tile_aligned:
+          tile_info = grid_info['tileInfo']
+          for p in period[1:]:
+              other = self.get_period_info(p)['tileInfo']
+              if (other['origin'], other['rows'], other['cols']) != (tile_info['origin'], tile_info['rows'], tile_info['cols']):
+                  raise ValueError(f"Period '{p}' has different tile grid than '{period[0]}'")
+          params, dims, dims_pixel = get_tile_params(x, y, width, height, grid_info['resolution'], tile_info)
+          fetch = lambda p, param, out: self.__get_tile_map(p, lod, param, rgb_standardized, out)
+      else:
+          params, dims, dims_pixel = get_params(x, y, width, height, grid_info['resolution'], grid_info['maxImageWidth'], grid_info['maxImageHeight'], grid_info['scale'], self.image_format)
+          params = params[::-1]
+          fetch = lambda p, param, out: self.__get_map_from_bottom_left_corner(p, param, rgb_standardized, out)
+      return params, dims, dims_pixel, fetch
+
+  def __get_coverage_mask(self, coverage, x, y, width, height, lod, kind, shape, chunk_size = None):
+      # The plan must be of the same area and parts, otherwise it would skip the wrong ones
+      if coverage is None:
+          return None
+      if (coverage.kind != kind or coverage.lod != lod or coverage.chunk_size != chunk_size or coverage.mask.shape != tuple(shape)
+              or not all(math.isclose(a, b, abs_tol=1e-6) for a, b in zip((coverage.x, coverage.y, coverage.width, coverage.height), (x, y, width, height)))):
+          raise ValueError(f"Coverage plan ({coverage.kind}, lod {coverage.lod}) does not match the {kind} parts at lod {lod} of the area")
+      return coverage.mask
+
+  def get_map_from_bottom_left_corner_generator(self, x, y, width, height, period, lod, rgb_standardized = True, max_workers = None, tile_aligned = False, coverage = None):
+      """
+      Rows are yielded top to bottom and are best consumed in that order, tiles
+      of a row not consumed before the next row is requested are kept in memory
+      until they are (e.g. list() of the rows holds the whole mosaic).
+      With max_workers > 1 up to max_workers requests are in flight at once.
+      With tile_aligned the area is assembled from cached tiles of the service
+      grid (/tile/{level}/{row}/{col}) instead of export renders, so overlapping
+      areas reuse the same tiles.
+      With coverage (coverage_planner.plan_coverage of the same area) tiles
+      outside the polygon are not requested and yielded white (0 if rgb_standardized).
+      """
+      if max_workers is None: max_workers = self.max_workers
+      params, dims, dims_pixel, fetch = self.__get_plan(x, y, width, height, period, lod, rgb_standardized, tile_aligned)
+      mask = self.__get_coverage_mask(coverage, x, y, width, height, lod, 'tile' if tile_aligned else 'export', (len(params), len(params[0])))
+      fill = 0.0 if rgb_standardized else np.uint8(255)
+      return self.__get_map_from_bottom_left_corner_generator_y(period, params, dims, fetch, max_workers, mask, fill), dims, dims_pixel
 
-  def get_map_from_bottom_left_corner(self, x, y, width, height, period, lod, rgb_standardized = True):
-      maps, dims, dims_pixel = self.get_map_from_bottom_left_corner_generator(x, y, width, height, period, lod, rgb_standardized)
-      map = np.concatenate([np.concatenate(list(x_s), axis = 1) for x_s in maps], axis = 0)
+  def get_map_shape(self, width, height, period, lod):
+      """
+      Returns shape (H, W, periods, 3) of the map get_map_from_bottom_left_corner returns.
+      """
+      resolution = self.get_grid_info(period, lod)['resolution']
+      return (meaters_to_pixels(height, resolution), meaters_to_pixels(width, resolution), len(period), 3)
+
+  def get_map_from_bottom_left_corner(self, x, y, width, height, period, lod, rgb_standardized = True, max_workers = None, tile_aligned = False, out = None, normalizer = None, coverage = None):
+      """
+      Every decoded tile is copied into its slice of one (H, W, periods, 3)
+      array. out can be a preallocated array or np.memmap of that shape (see
+      get_map_shape), which allows maps larger than memory.
+
+      With normalizer (normalization.ChannelStandardizer or PercentileStretch)
+      tiles are kept as uint8, the normalizer statistics are updated while tiles
+      arrive (unless it is frozen, e.g. loaded from a saved reference) and the
+      whole mosaic is normalized with them at the end into normalizer.dtype.
+      rgb_standardized is ignored in that case.
+
+      With coverage (coverage_planner.plan_coverage of the same area) tiles
+      outside the polygon are not requested and left white (0 if
+      rgb_standardized), and they do not count into normalizer statistics.
+      """
+      if max_workers is None: max_workers = self.max_workers
+      if normalizer is not None: rgb_standardized = False
+      params, dims, dims_pixel, fetch = self.__get_plan(x, y, width, height, period, lod, rgb_standardized, tile_aligned)
+      mask = self.__get_coverage_mask(coverage, x, y, width, height, lod, 'tile' if tile_aligned else 'export', (len(params), len(params[0])))
+      shape = (dims_pixel[1], dims_pixel[0], len(period), 3)
+      if out is not None and out.shape != shape:
+          raise ValueError(f"out has shape {out.shape}, expected {shape}")
+      if normalizer is not None:
+          map = np.empty(shape, dtype = np.uint8)
+      elif out is None:
+          map = np.empty(shape, dtype = float if rgb_standardized else np.uint8)
+      else:
+          map = out
+      timed = self.metrics.enabled
+      if timed: mosaic_started = time.perf_counter()
+      key = next(self.mosaic_ids)
+      tiles = self.__get_tiles(period, params, fetch, max_workers, map, mask, np.uint8(255) if map.dtype == np.uint8 else 0.0)
+      covered = itertools.repeat(True) if mask is None else mask.ravel()
+      for (tile_slice, _), (param, maps), keep in zip(get_tile_slices(params), tiles, covered):
+          self.__log_tile(period, dims, key, maps)
+          if normalizer is not None and keep:
+              if timed: started = time.perf_counter()
+              normalizer.update(map[tile_slice])
+              if timed: self.metrics.emit('normalize_seconds', time.perf_counter() - started, mosaic=key)
+      if normalizer is not None:
+          if timed: started = time.perf_counter()
+          map = normalizer.transform(map, out)
+          if timed: self.metrics.emit('normalize_seconds', time.perf_counter() - started, mosaic=key)
+      if timed:
+          self.metrics.emit('mosaic_seconds', time.perf_counter() - mosaic_started, mosaic=key, periods=len(period))
+          self.metrics.emit('mosaic_pixels', shape[0] * shape[1] * len(period), mosaic=key, periods=len(period))
       return map, dims_pixel
 
-  def get_map_from_center_generator(self, x, y, width, height, period, lod, rgb_standardized = True):
+  def get_map_from_plan(self, plan, rgb_standardized = True, max_workers = None, out = None, normalizer = None):
+      """
+      Returns mosaic of the bounding box of a coverage plan (see coverage_planner.plan_coverage),
+      only the tiles that cover the polygon are requested.
+      """
+      return self.get_map_from_bottom_left_corner(plan.x, plan.y, plan.width, plan.height, plan.period, plan.lod, rgb_standardized, max_workers, plan.tile_aligned, out, normalizer, plan)
+
+  def get_time_series_from_bottom_left_corner(self, x, y, width, height, lod, period = None, max_workers = None, tile_aligned = False):
+      """
+      Get all periods of an area as one uint8 cube.
+
+      Periods that share resolution at lod are fetched together, so every tile
+      of all of them is requested concurrently, and the groups themselves run
+      at the same time. Periods whose resolution at lod is coarser than the
+      finest one are fetched on their own grid and resampled (bilinear) onto
+      the finest grid.
+
+      :param x: x coordinate of bottom left corner in EPSG3346
+      :param y: y coordinate of bottom left corner in EPSG3346
+      :param width: width of map in meters
+      :param height: height of map in meters
+      :param lod: level of detail of map
+      :param period: list of periods, all periods if None
+      :param max_workers: requests in flight per group, by default self.max_workers per period of the group
+
+      :return: cube of shape (T, H, W, 3), list of T period labels
+      """
+      if period is None: period = self.get_period_names()
+      groups = []
+      for i, p in enumerate(period):
+          period_lod_info = self.get_period_lods_info(p).get(lod)
+          if period_lod_info is None:
+              raise ValueError(f"Period '{p}' has no lod {lod}")
+          for group in groups:
+              if math.isclose(group['resolution'], period_lod_info['resolution'], rel_tol=1e-9):
+                  group['index'].append(i)
+                  break
+          else:
+              groups.append({'resolution': period_lod_info['resolution'], 'index': [i]})
+      resolution = min(group['resolution'] for group in groups)
+      height_px, width_px = meaters_to_pixels(height, resolution), meaters_to_pixels(width, resolution)
+      cube = np.empty((len(period), height_px, width_px, 3), dtype=np.uint8)
+      def fetch(group):
+          group_period = [period[i] for i in group['index']]
+          # Groups run at the same time, so the default adds up to self.max_workers per period
+          group_workers = max_workers if max_workers is not None else self.max_workers * len(group_period)
+          return group, self.get_map_from_bottom_left_corner(x, y, width, height, group_period, lod, False, group_workers, tile_aligned)[0]
+      for group, map in ordered_concurrent_map(fetch, groups, len(groups)):
+          for k, i in enumerate(group['index']):
+              if map.shape[:2] == (height_px, width_px):
+                  cube[i] = map[:, :, k]
+              else:
+                  cube[i] = np.asarray(Image.fromarray(np.ascontiguousarray(map[:, :, k])).resize((width_px, height_px), Image.BILINEAR))
+      return cube, list(period)
+
+  def get_time_series_from_center(self, x, y, width, height, lod, period = None, max_workers = None, tile_aligned = False):
+      x = x - width / 2
+      y = y - height / 2
+      return self.get_time_series_from_bottom_left_corner(x, y, width, height, lod, period, max_workers, tile_aligned)
+
+  def download_to_store(self, directory, x, y, width, height, period, lod, chunk_size = 1024, max_workers = None, tile_aligned = False, coverage = None):
+      """
+      Downloads area into a RasterStore, one chunk of chunk_size x chunk_size pixels at a time.
+
+      Chunks already present in the store are skipped, so an interrupted
+      download continues where it stopped when called again with the same arguments.
+      With coverage (coverage_planner.plan_coverage with chunk_size) only chunks
+      that cover the polygon are downloaded, in Z-order, the others stay missing.
+
+      :param directory: directory of the store
+      :param x: x coordinate of bottom left corner in EPSG3346
+      :param y: y coordinate of bottom left corner in EPSG3346
+      :param width: width of map in meters
+      :param height: height of map in meters
+      :param period: list of periods of map
+      :param lod: level of detail of map
+      :param coverage: CoveragePlan of kind 'chunk' of the same area and chunk_size
+
+      :return: RasterStore with uint8 raster of shape (H, W, periods, 3)
+      """
+      resolution = self.get_grid_info(period, lod)['resolution']
+      shape = self.get_map_shape(width, height, period, lod)
+      chunk_dims = (math.ceil(shape[0] / chunk_size), math.ceil(shape[1] / chunk_size))
+      self.__get_coverage_mask(coverage, x, y, width, height, lod, 'chunk', chunk_dims, chunk_size)
+      store = RasterStore.create(directory, shape, (chunk_size, chunk_size), np.uint8, [x, resolution, 0, y + height, 0, -resolution], period, lod)
+      chunks = store.get_missing_chunks()
+      if coverage is not None:
+          missing = set(chunks)
+          chunks = [chunk for chunk in coverage.order if chunk in missing]
+      for row, col in chunks:
+          top, bottom, left, right = store.get_chunk_window(row, col)
+          chunk, _ = self.get_map_from_bottom_left_corner(x + left * resolution, y + height - bottom * resolution, (right - left) * resolution, (bottom - top) * resolution, period, lod, False, max_workers, tile_aligned)
+          store.write_chunk(row, col, chunk)
+      return store
+
+  def get_map_from_center_generator(self, x, y, width, height, period, lod, rgb_standardized = True, max_workers = None, tile_aligned = False):
       x = x - width / 2
       y = y - height / 2
-      return self.get_map_from_bottom_left_corner_generator(x, y, width, height, period, lod, rgb_standardized)
+      return self.get_map_from_bottom_left_corner_generator(x, y, width, height, period, lod, rgb_standardized, max_workers, tile_aligned)
 
-  def get_map_from_center(self, x, y, width, height, period, lod, rgb_standardized = True):
+  def get_map_from_center(self, x, y, width, height, period, lod, rgb_standardized = True, max_workers = None, tile_aligned = False, out = None, normalizer = None):
       x = x - width / 2
       y = y - height / 2
-      return self.get_map_from_bottom_left_corner(x, y, width, height, period, lod, rgb_standardized)
+      return self.get_map_from_bottom_left_corner(x, y, width, height, period, lod, rgb_standardized, max_workers, tile_aligned, out, normalizer)
+
+@functools.lru_cache(maxsize=None)
+def get_api():
+    """
+    Returns the shared GeoportalAPI, created on first use.
+    """
+    return GeoportalAPI(cache = TileCache(CACHE_DIR, CACHE_MAX_BYTES), metadata_dir = METADATA_DIR)
+
+@functools.lru_cache(maxsize=None)
+def get_transformer():
+    return EPSG4326_TO_EPSG3346()
+
+def __getattr__(name):
+    # Keeps `from api_geoportal import api, transformer` working without creating them at import
+    if name == 'api':
+        return get_api()
+    if name == 'transformer':
+        return get_transformer()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
-api = GeoportalAPI()
-transformer = EPSG4326_TO_EPSG3346()
 resolutions_dict = {
     '529.16m': 1,
     '264.58m': 2,
@@ -234,11 +762,167 @@ def get_geoportal_lt_map(lat, lon, diameter, resolution, period):
     Example:
     >>> map_image = get_geoportal_lt_map(54.6872, 25.2797, 1000, '26.45m', '2021-2023')
     """
-    x, y = transformer.transform(lat, lon)
-    map = api.get_map_from_center(x, y, diameter, diameter, [period], resolutions_dict[resolution], False)
+    x, y = get_transformer().transform(lat, lon)
+    map = get_api().get_map_from_center(x, y, diameter, diameter, [period], resolutions_dict[resolution], False)
     map = map[0][:,:,0,:]
     return map
 
+def get_geoportal_lt_time_series(lat, lon, diameter, resolution, period = None):
+    """
+    Retrieves maps of all periods for one location, see get_geoportal_lt_map.
+
+    Parameters:
+    lat (float): Latitude of the center point.
+    lon (float): Longitude of the center point.
+    diameter (float): Diameter of the area to be mapped, in meters.
+    resolution (str): Resolution of the map images.
+    period (list): Time periods, all periods (1995-2023) if None.
+
+    Returns:
+    numpy.ndarray: uint8 array of shape (T, H, W, 3).
+    list: T period labels.
+
+    Example:
+    >>> cube, periods = get_geoportal_lt_time_series(54.6872, 25.2797, 100, '0.52m')
+    """
+    x, y = get_transformer().transform(lat, lon)
+    return get_api().get_time_series_from_center(x, y, diameter, diameter, resolutions_dict[resolution], period)
+
+def iter_patches(x, y, diameter, lod, period, max_workers = 8, coalesce = False, tolerance = 1.0, tile_aligned = False, ordered = True):
+    """
+    Retrieves square patches around many points in EPSG3346.
+
+    With coalesce, points closer than tolerance meters are fetched once and
+    nearby points are grouped (see spatial_index.group_points) into one larger
+    request that is cropped locally. Cropping snaps patches to the pixel grid
+    of the group window, so they can be shifted by less than one pixel compared
+    to separate requests.
+
+    Args:
+      x: x coordinates of patch centres.
+      y: y coordinates of patch centres.
+      diameter: Patch side in meters.
+      lod: Level of detail.
+      period: List of periods.
+      max_workers: Number of requests in flight at the same time.
+      coalesce: Deduplicate and group nearby points.
+      tolerance: Distance in meters under which points are duplicates.
+      tile_aligned: Assemble maps from cached service tiles.
+      ordered: Yield in input order. With coalesce, members of a group can be far
+               apart in input order and patches wait in memory for their turn,
+               unordered patches are yielded as soon as their group arrives.
+
+    Returns:
+      Generator of (index, map of shape (H, W, periods, 3), error), in input order if ordered.
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+    api = get_api()
+    def fetch_one(i):
+        try:
+            return [(i, api.get_map_from_center(x[i], y[i], diameter, diameter, period, lod, False, 1, tile_aligned)[0], None)]
+        except Exception as error:
+            return [(i, None, error)]
+    def fetch_group(group):
+        members, duplicates = group
+        if len(members) == 1 and not duplicates:
+            return fetch_one(members[0])
+        resolution = api.get_grid_info(period, lod)['resolution']
+        size = meaters_to_pixels(diameter, resolution)
+        left = x[members].min() - diameter / 2 - resolution
+        bottom = y[members].min() - diameter / 2 - resolution
+        width = pixels_to_meaters(meaters_to_pixels(np.ptp(x[members]) + diameter + 2 * resolution, resolution), resolution)
+        height = pixels_to_meaters(meaters_to_pixels(np.ptp(y[members]) + diameter + 2 * resolution, resolution), resolution)
+        try:
+            window, _ = api.get_map_from_bottom_left_corner(left, bottom, width, height, period, lod, False, 1, tile_aligned)
+        except Exception as error:
+            return [(i, None, error) for i in members + duplicates]
+        results = []
+        for i in members:
+            col = int(round((x[i] - diameter / 2 - left) / resolution))
+            row = int(round((bottom + height - (y[i] + diameter / 2)) / resolution))
+            # Copies, so patches waiting for their turn do not keep the whole window alive
+            results.append((i, window[row:row + size, col:col + size].copy(), None))
+        representatives = dict((i, map) for i, map, _ in results)
+        # Duplicates get copies of their representative's patch, callers may modify patches in place
+        return results + [(j, representatives[representative[j]].copy(), None) for j in duplicates]
+    if coalesce:
+        representative = deduplicate(x, y, tolerance)
+        unique = np.flatnonzero(representative == np.arange(len(x)))
+        grid_info = api.get_grid_info(period, lod)
+        resolution = grid_info['resolution']
+        max_extent = pixels_to_meaters(min(grid_info['maxImageWidth'], grid_info['maxImageHeight']), resolution) - 4 * resolution
+        duplicates = {i: [] for i in unique}
+        for j in np.flatnonzero(representative != np.arange(len(x))):
+            duplicates[representative[j]].append(j)
+        jobs = []
+        for group in group_points(x[unique], y[unique], diameter, max_extent):
+            members = unique[group].tolist()
+            jobs.append((members, [j for i in members for j in duplicates[i]]))
+        fetch = fetch_group
+    else:
+        jobs = range(len(x))
+        fetch = fetch_one
+    # Groups finish out of input order, results are held back until their turn
+    buffer = {}
+    next_index = 0
+    for results in ordered_concurrent_map(fetch, jobs, max_workers):
+        if not ordered:
+            yield from results
+            continue
+        for result in results:
+            buffer[result[0]] = result
+        while next_index in buffer:
+            yield buffer.pop(next_index)
+            next_index += 1
+
+def iter_geoportal_lt_maps(lat, lon, diameter, resolution, period, max_workers = 8, coalesce = False, tolerance = 1.0):
+    """
+    Retrieves maps for many locations, see get_geoportal_lt_map.
+
+    All coordinates are projected with one pyproj call and maps are fetched
+    concurrently through the shared api (and its tile cache). A failure of one
+    location is reported with its result instead of stopping the batch.
+
+    Parameters:
+    lat (array-like): Latitudes, e.g. df['lat'].
+    lon (array-like): Longitudes, e.g. df['lon'].
+    diameter (float): Diameter of the area to be mapped, in meters.
+    resolution (str): Resolution of the map images, see get_geoportal_lt_map.
+    period (str): Time period of the map data, see get_geoportal_lt_map.
+    max_workers (int): Number of requests in flight at the same time.
+    coalesce (bool): Fetch duplicates once and nearby locations together, see iter_patches.
+    tolerance (float): Distance in meters under which locations are duplicates.
+
+    Returns:
+    Generator of (index, map, error) in input order. map is None if error is not None.
+    """
+    x, y = get_transformer().transform(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+    for i, map, error in iter_patches(x, y, diameter, resolutions_dict[resolution], [period], max_workers, coalesce, tolerance):
+        yield i, map[:,:,0,:] if map is not None else None, error
+
+def get_geoportal_lt_maps(lat, lon, diameter, resolution, period, max_workers = 8, coalesce = False, tolerance = 1.0):
+    """
+    Retrieves maps for many locations as one array, see iter_geoportal_lt_maps.
+
+    Returns:
+    numpy.ndarray: uint8 array of shape (N, H, W, 3), maps of failed locations are zeros.
+    dict: Exceptions of failed locations by their index.
+
+    Example:
+    >>> df = pd.read_csv('../data/abandoned_building_locations.csv')
+    >>> maps, errors = get_geoportal_lt_maps(df['lat'], df['lon'], 100, '0.52m', '2021-2023')
+    """
+    shape = get_api().get_map_shape(diameter, diameter, [period], resolutions_dict[resolution])
+    maps = np.zeros((len(lat), shape[0], shape[1], 3), dtype=np.uint8)
+    errors = {}
+    for i, map, error in iter_geoportal_lt_maps(lat, lon, diameter, resolution, period, max_workers, coalesce, tolerance):
+        if error is not None:
+            errors[i] = error
+        else:
+            maps[i] = map
+    return maps, errors
+
 
 if False:
     lat = 55.4642
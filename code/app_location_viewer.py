@@ -1,23 +1,74 @@
 from api_geoportal import get_geoportal_lt_map
+from tile_cache import TileCache
+from location_store import LocationStore
 import dash
+import flask
+import hashlib
+import os
 from dash import html, dcc, callback, Input, Output, State
 import dash_bootstrap_components as dbc
-import pandas as pd
-import base64
 import io
 from PIL import Image
 import re
-import requests
+import http_session
 import numpy as np
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from config import GOOGLE_MAPS_API_KEY
 from io import BytesIO
 
-def numpy_to_b64(arr):
+# Seconds all external calls of one location may take, panels not ready by
+# then are shown as placeholders. Viewer calls are not retried, a slow answer
+# is worth less than a placeholder.
+CALL_TIMEOUT = 10
+call_executor = ThreadPoolExecutor(max_workers=16)
+# Landmark photos are requested from a call_executor task, a pool of their own
+# keeps that task from waiting on its own pool
+photo_executor = ThreadPoolExecutor(max_workers=8)
+# Prefetch renders use pools of their own (calls, photos), so calls of the
+# location being shown never queue behind calls of its neighbours
+prefetch_executors = (ThreadPoolExecutor(max_workers=8), ThreadPoolExecutor(max_workers=4))
+viewer_http = http_session.HttpClient(max_retries=0, timeout=CALL_TIMEOUT)
+
+def placeholder_image(width=600, height=400):
+    return np.full((height, width, 3), 220, dtype=np.uint8)
+
+def results_by_deadline(futures, deadline):
+    """
+    Waits for futures until deadline (time.monotonic()) at most, returns their results, None for failed or late ones.
+    """
+    wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+    results = []
+    for future in futures:
+        if future.done() and not future.cancelled() and future.exception() is None:
+            results.append(future.result())
+        else:
+            # Only calls still queued are cancelled, running ones finish in the background
+            future.cancel()
+            results.append(None)
+    return results
+
+# Images are served from /images/<sha256>.<ext>, the url changes whenever the
+# content does, so browsers may cache them forever
+IMAGE_FORMAT = 'JPEG'
+IMAGE_QUALITY = 85
+IMAGE_MIMETYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp', 'png': 'image/png'}
+IMAGE_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+IMAGE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'geoportal_lt', 'viewer_images')
+image_cache = TileCache(IMAGE_CACHE_DIR, 256 * 1024 ** 2)
+
+def numpy_to_url(arr, max_width=None, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
     im = Image.fromarray(arr)
+    if max_width is not None and im.width > max_width:
+        im = im.resize((max_width, round(im.height * max_width / im.width)), Image.LANCZOS)
     buffer = io.BytesIO()
-    im.save(buffer, format="PNG")
-    encoded_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    return f"data:image/png;base64,{encoded_image}"
+    im.save(buffer, format=image_format, quality=quality)
+    data = buffer.getvalue()
+    key = hashlib.sha256(data).hexdigest()
+    image_cache.put(key, data)
+    return f"/images/{key}.{IMAGE_EXTENSIONS[image_format]}"
 
 def make_url_markdown(text):
     url_pattern = r'(https?://\S+)'
@@ -40,7 +91,7 @@ def get_static_map(lat, lon, zoom=6, size="400x400"):
         "markers": f"color:red|{lat},{lon}",
         "key": GOOGLE_MAPS_API_KEY  # Replace with your actual API key
     }
-    response = requests.get(base_url, params=params)
+    response = viewer_http.get(base_url, params=params)
     img = Image.open(io.BytesIO(response.content))
     return np.array(img)
 
@@ -52,7 +103,7 @@ def get_street_view_image(lat, lon, api_key, heading):
         "heading": heading,
         "key": api_key
     }
-    response = requests.get(base_url, params=params)
+    response = viewer_http.get(base_url, params=params)
     if response.status_code == 200:
         img = Image.open(BytesIO(response.content)).convert('RGB')
         return np.array(img)
@@ -66,7 +117,7 @@ def get_nearby_landmarks(lat, lon, api_key):
         "type": "tourist_attraction",
         "key": api_key
     }
-    response = requests.get(base_url, params=params)
+    response = viewer_http.get(base_url, params=params)
     if response.status_code == 200:
         return response.json().get('results', [])
     return []
@@ -78,7 +129,7 @@ def get_place_photos(place_id, api_key, max_photos=2):
         "fields": "photo",
         "key": api_key
     }
-    response = requests.get(base_url, params=params)
+    response = viewer_http.get(base_url, params=params)
     if response.status_code == 200:
         photos = response.json().get('result', {}).get('photos', [])
         return [photo['photo_reference'] for photo in photos[:max_photos]]
@@ -91,41 +142,192 @@ def get_place_photo(photo_reference, api_key):
         "photo_reference": photo_reference,
         "key": api_key
     }
-    response = requests.get(base_url, params=params)
+    response = viewer_http.get(base_url, params=params)
     if response.status_code == 200:
         img = Image.open(BytesIO(response.content)).convert('RGB')
         return np.array(img)
     return None
 
-def get_location_images(lat, lon, api_key, total_images=4):
-    images = []
-    
-    # Get landmark images
+def get_landmark_images(lat, lon, api_key, max_photos=2, deadline=None, executor=None):
+    if deadline is None: deadline = time.monotonic() + CALL_TIMEOUT
+    if executor is None: executor = photo_executor
     landmarks = get_nearby_landmarks(lat, lon, api_key)
-    if landmarks:
-        closest_landmark = landmarks[0]
-        photo_references = get_place_photos(closest_landmark['place_id'], api_key, max_photos=2)
-        for photo_ref in photo_references:
-            img = get_place_photo(photo_ref, api_key)
-            if img is not None:
-                images.append(img)
-    
+    if not landmarks:
+        return []
+    closest_landmark = landmarks[0]
+    photo_references = get_place_photos(closest_landmark['place_id'], api_key, max_photos=max_photos)
+    futures = [executor.submit(get_place_photo, photo_ref, api_key) for photo_ref in photo_references]
+    images = results_by_deadline(futures, deadline)
+    return [img for img in images if img is not None]
+
+def pick_headings(total_images, count):
+    return set(np.linspace(0, total_images, count, endpoint=False).astype(int).tolist())
+
+def get_location_images(lat, lon, api_key, total_images=4, max_photos=2, deadline=None, executors=None):
+    # Street View is shown at an evenly spread subset of total_images headings
+    # for the slots not taken by landmark photos. Headings needed whatever the
+    # landmarks return are requested at once, the rest only once it is known
+    # they are needed, so no paid call is thrown away.
+    # Returns the images and how many of them are placeholders.
+    if deadline is None: deadline = time.monotonic() + CALL_TIMEOUT
+    calls, photos = executors or (call_executor, photo_executor)
+    landmark_future = calls.submit(get_landmark_images, lat, lon, api_key, max_photos, deadline, photos)
+    street_view_futures = {i: calls.submit(get_street_view_image, lat, lon, api_key, i * (360 / total_images))
+                           for i in pick_headings(total_images, max(0, total_images - max_photos))}
+
+    images = (results_by_deadline([landmark_future], deadline)[0] or [])[:total_images]
+
     # Fill the rest with Street View images
-    street_view_count = total_images - len(images)
-    for i in range(street_view_count):
-        heading = i * (360 / street_view_count)
-        img = get_street_view_image(lat, lon, api_key, heading)
-        if img is not None:
-            images.append(img)
+    picked = pick_headings(total_images, total_images - len(images)) | set(street_view_futures)
+    if time.monotonic() < deadline:
+        for i in sorted(picked - set(street_view_futures)):
+            street_view_futures[i] = calls.submit(get_street_view_image, lat, lon, api_key, i * (360 / total_images))
+    requested = sorted(set(street_view_futures))
+    street_views = results_by_deadline([street_view_futures[i] for i in requested], deadline)
+    images += [img for img in street_views if img is not None]
+    placeholders = max(0, total_images - len(images))
+    images += [placeholder_image() for _ in range(placeholders)]
+    return images[:total_images], placeholders
+
+def render_location(lat, lon, executors=None):
+    # Returns the panel and whether it is complete, a panel with any
+    # placeholder is not. executors are the (calls, photos) pools to use.
+    # One deadline for all calls, a click takes about as long as the slowest call
+    deadline = time.monotonic() + CALL_TIMEOUT
+    calls = (executors or (call_executor, photo_executor))[0]
+    image_future = calls.submit(get_geoportal_lt_map, lat, lon, 100, '0.13m', '2021-2023')
+    map_image_future = calls.submit(get_static_map, lat, lon)
+    image_arrays, placeholders = get_location_images(lat, lon, GOOGLE_MAPS_API_KEY, deadline=deadline, executors=executors)
+
+    image_array, map_image_array = results_by_deadline([image_future, map_image_future], deadline)
+    image_url = numpy_to_url(image_array if image_array is not None else placeholder_image(770, 770), max_width=800)
+
+    map_image_url = numpy_to_url(map_image_array if map_image_array is not None else placeholder_image(400, 400), max_width=400)
     
-    return images
+    image_display = html.Div([
+        dbc.Row([
+            dbc.Col([
+                html.Img(src=image_url, style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
+            ], width=8),
+            dbc.Col([
+                html.Img(src=map_image_url, style={'width': '100%', 'height': 'auto', 'object-fit': 'contain', 'margin-bottom': '10px'}),
+                html.Img(src=numpy_to_url(image_arrays[0], max_width=400), style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
+            ], width=4)
+        ]),
+        dbc.Row([
+            dbc.Col([
+                html.Img(src=numpy_to_url(image_arrays[1], max_width=400), style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
+            ], width=4),
+            dbc.Col([
+                html.Img(src=numpy_to_url(image_arrays[2], max_width=400), style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
+            ], width=4),
+            dbc.Col([
+                html.Img(src=numpy_to_url(image_arrays[3], max_width=400), style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
+            ], width=4)
+        ])
+    ])
+    complete = placeholders == 0 and image_array is not None and map_image_array is not None
+    return image_display, complete
+
+# Complete image panels of recently shown and prefetched locations, keyed by
+# (lat, lon). Panels with placeholders are not kept, they are rendered again.
+PREFETCH_ROWS = 2
+RENDER_CACHE_SIZE = 32
+render_executor = ThreadPoolExecutor(max_workers=2 * PREFETCH_ROWS)
+render_cache = OrderedDict()
+render_futures = {}
+render_lock = threading.Lock()
+
+def get_image_keys(component):
+    src = getattr(component, 'src', None)
+    if isinstance(src, str) and src.startswith('/images/'):
+        yield src[len('/images/'):].split('.')[0]
+    children = getattr(component, 'children', None)
+    for child in children if isinstance(children, (list, tuple)) else [children]:
+        if child is not None and not isinstance(child, str):
+            yield from get_image_keys(child)
+
+def images_available(image_display):
+    # Images live in image_cache, which evicts on its own. Using a panel marks
+    # its images as recently used, a panel with evicted images is rendered again.
+    return all([image_cache.touch(key) for key in get_image_keys(image_display)])
+
+def store_rendered_location(key, image_display):
+    with render_lock:
+        render_cache[key] = image_display
+        render_cache.move_to_end(key)
+        while len(render_cache) > RENDER_CACHE_SIZE:
+            render_cache.popitem(last=False)
+
+def on_location_rendered(key, future):
+    with render_lock:
+        render_futures.pop(key, None)
+    if future.exception() is None:
+        image_display, complete = future.result()
+        if complete:
+            store_rendered_location(key, image_display)
+
+def prefetch_location(lat, lon):
+    key = (lat, lon)
+    with render_lock:
+        if key in render_futures or (key in render_cache and images_available(render_cache[key])):
+            return
+        future = render_executor.submit(render_location, lat, lon, prefetch_executors)
+        render_futures[key] = future
+    future.add_done_callback(lambda f: on_location_rendered(key, f))
 
-server_storage = {}
+def get_rendered_location(lat, lon):
+    key = (lat, lon)
+    with render_lock:
+        if key in render_cache:
+            if images_available(render_cache[key]):
+                render_cache.move_to_end(key)
+                return render_cache[key]
+            del render_cache[key]
+        future = render_futures.get(key)
+    if future is not None:
+        image_display, _ = future.result()
+        if images_available(image_display):
+            return image_display
+    # Not prefetched, render in the callback thread instead of queueing behind prefetches
+    image_display, complete = render_location(lat, lon)
+    if complete:
+        store_rendered_location(key, image_display)
+    return image_display
+
+def prefetch_locations(store, order, row):
+    for step in range(1, PREFETCH_ROWS + 1):
+        for neighbour in (row + step, row - step):
+            neighbour_row = order[neighbour % len(order)]
+            prefetch_location(float(store.lat[neighbour_row]), float(store.lon[neighbour_row]))
+
+# Opened stores are read only memory maps, every server process keeps its own.
+# The selected file and row live in the browser (dcc.Store), so any process
+# can answer any callback.
+DEFAULT_LOCATIONS = '../data/abandoned_building_locations.csv'
+location_stores = {}
+location_stores_lock = threading.Lock()
+
+def get_location_store(filename, refresh=False):
+    with location_stores_lock:
+        if refresh or filename not in location_stores:
+            location_stores[filename] = LocationStore.open(filename)
+        return location_stores[filename]
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], assets_folder='assets')
 
 app.config.suppress_callback_exceptions = True
 
+@app.server.route('/images/<key>.<extension>')
+def serve_image(key, extension):
+    data = image_cache.get(key) if re.fullmatch(r'[0-9a-f]{64}', key) else None
+    if data is None or extension not in IMAGE_MIMETYPES:
+        flask.abort(404)
+    response = flask.Response(data, mimetype=IMAGE_MIMETYPES[extension])
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['ETag'] = key
+    return response
+
 app.layout = dbc.Container([
     dbc.Row([
         dbc.Col([
@@ -136,6 +338,8 @@ app.layout = dbc.Container([
             ),
             html.Div(id='file-menu'),
             html.Div(id='file-row-menu'),
+            dcc.Store(id='location-file'),
+            dcc.Store(id='location-row', data=0),
             dcc.Dropdown(id='source-filter', multi=True, placeholder="Select source(s)", value=["niekonaujo"]),
             dbc.Button("Previous", id="prev-button"),
             dbc.Button("Next", id="next-button")
@@ -149,61 +353,55 @@ app.layout = dbc.Container([
 @callback(
     Output('file-menu', 'children'),
     Output('source-filter', 'options'),
+    Output('location-file', 'data'),
     Input('upload-data', 'filename')
 )
 def update_file_menu(filename):
-    if filename is None: filename = '../data/abandoned_building_locations.csv'
-    server_storage['locations_row'] = 0
-    df = pd.read_csv(filename, encoding='utf8')
-    # df = df[df['source'] != "truristo"]
-    # df = df[df['source'] != "dvarai2"]
-    # df = df[df['source'] != "dvarai"]
-    # df = df[df['source'] != "moltovolinija"]
-    # df = df[df['source'] == "niekonaujo"]
-    df = df.sample(frac=1).reset_index(drop=True)
-    server_storage['locations'] = df
-    sources = df['source'].unique().tolist()
+    if filename is None: filename = DEFAULT_LOCATIONS
+    # The store is rebuilt only if the csv changed since it was built
+    store = get_location_store(filename, refresh=True)
     return html.Div([
         html.P(f"Selected: '{filename}'")
-    ]), sources
+    ]), store.sources, filename
 
 @callback(
     Output('file-row-menu', 'children'),
     Output('image-display', 'children'),
+    Output('location-row', 'data'),
     Input('prev-button', 'n_clicks'),
     Input('next-button', 'n_clicks'),
     Input('source-filter', 'value'),
-    State('file-row-menu', 'children')
+    Input('location-file', 'data'),
+    State('location-row', 'data')
 )
-def update_file_row_menu(prev_clicks, next_clicks, selected_sources, current_children):
-    if not ("locations" in server_storage): return html.Div(), html.Div()
+def update_file_row_menu(prev_clicks, next_clicks, selected_sources, filename, row):
+    if filename is None: return html.Div(), html.Div(), 0
     ctx = dash.callback_context
     if not ctx.triggered:
         button_id = 'No clicks yet'
     else:
         button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-        
-    if selected_sources:
-        filtered_df = server_storage['locations'][server_storage['locations']['source'].isin(selected_sources)]
-    else:
-        filtered_df = server_storage['locations']
-        
-    if 'filtered_row' not in server_storage:
-        server_storage['filtered_row'] = 0
-
-    if button_id == 'prev-button' and prev_clicks is not None:
-        server_storage['filtered_row'] = server_storage['filtered_row'] - 1
-        if (server_storage['filtered_row'] < 0): server_storage['filtered_row'] = len(filtered_df) - 1
+
+    store = get_location_store(filename)
+    order = store.get_order(selected_sources)
+    if len(order) == 0: return html.Div([html.P("No rows")]), html.Div(), 0
+    row = row or 0
+
+    if button_id == 'location-file':
+        row = 0
+    elif button_id == 'prev-button' and prev_clicks is not None:
+        row = row - 1
+        if (row < 0): row = len(order) - 1
     elif button_id == 'next-button' and next_clicks is not None:
-        server_storage['filtered_row'] = server_storage['filtered_row'] + 1
-        if (server_storage['filtered_row'] > len(filtered_df) - 1): server_storage['filtered_row'] = 0
-        
-    server_storage['filtered_row'] = min(server_storage['filtered_row'], len(filtered_df) - 1)
-    
-    current_row = filtered_df.iloc[server_storage['filtered_row']]
-    
+        row = row + 1
+        if (row > len(order) - 1): row = 0
+
+    row = min(row, len(order) - 1)
+
+    current_row = store.get_row(order[row])
+
     file_row_menu = html.Div([
-        html.P(f"Row {server_storage['filtered_row'] + 1} of {len(filtered_df)}"),
+        html.P(f"Row {row + 1} of {len(order)}"),
         html.Table([
             html.Tr([html.Th("Source:"), html.Td(f"{current_row['source']}")]),
             html.Tr([html.Th("Lat, Lon:"), html.Td(f"{current_row['lat']}, {current_row['lon']}")]),
@@ -212,39 +410,11 @@ def update_file_row_menu(prev_clicks, next_clicks, selected_sources, current_chi
             html.Tr([html.Th("Google maps:"), html.Td(make_urls_clickable(f"http://maps.google.com/maps?q={current_row['lat']},{current_row['lon']}"))])
         ])
     ])
-    
-    image_array = get_geoportal_lt_map(current_row['lat'], current_row['lon'], 100, '0.13m', '2021-2023')
-    image_b64 = numpy_to_b64(image_array)
-    
-    map_image_array = get_static_map(current_row['lat'], current_row['lon'])
-    map_image_b64 = numpy_to_b64(map_image_array)
-    
-    image_arrays = get_location_images(current_row['lat'], current_row['lon'], GOOGLE_MAPS_API_KEY)
-    
-    image_display = html.Div([
-        dbc.Row([
-            dbc.Col([
-                html.Img(src=image_b64, style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
-            ], width=8),
-            dbc.Col([
-                html.Img(src=map_image_b64, style={'width': '100%', 'height': 'auto', 'object-fit': 'contain', 'margin-bottom': '10px'}),
-                html.Img(src=numpy_to_b64(image_arrays[0]), style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
-            ], width=4)
-        ]),
-        dbc.Row([
-            dbc.Col([
-                html.Img(src=numpy_to_b64(image_arrays[1]), style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
-            ], width=4),
-            dbc.Col([
-                html.Img(src=numpy_to_b64(image_arrays[2]), style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
-            ], width=4),
-            dbc.Col([
-                html.Img(src=numpy_to_b64(image_arrays[3]), style={'width': '100%', 'height': 'auto', 'object-fit': 'contain'})
-            ], width=4)
-        ])
-    ])
-    
-    return file_row_menu, image_display
+
+    image_display = get_rendered_location(current_row['lat'], current_row['lon'])
+    prefetch_locations(store, order, row)
+
+    return file_row_menu, image_display, row
 
 
 # app.layout = dbc.Container([
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from api_geoportal import get_api, get_transformer, resolutions_dict, iter_patches
+from file_utils import write_atomic
+
+# Builds a patch dataset from abandoned building locations.
+#
+# For every (diameter, resolution) pair one sub directory is created:
+#   config.json     - periods, shard size and sample shape the directory was built with
+#   shard_00000.npy - uint8 array (shard_size, periods, H, W, 3)
+#   index.csv       - row_id, shard, offset of every downloaded sample
+#   errors.csv      - row_id, time, error of every failed download
+# Samples are keyed by the stable row ids of the csv (see
+# h_abandoned_building_from_web_to_csv.get_row_ids), every new id takes the
+# next free slot (shard, offset) in the order samples arrive. index.csv is the
+# checkpoint, it is rewritten after the shards are flushed, so a restarted
+# build fetches only ids it does not list, including ids whose download failed
+# and rows added to the csv since. Slots of rows removed from the csv stay in
+# the shards, index.csv still tells which id they belong to.
+
+INDEX_COLUMNS = ['row_id', 'shard', 'offset']
+ERROR_COLUMNS = ['row_id', 'time', 'error']
+
+def get_row_ids(df):
+    if 'id' in df.columns:
+        return df['id'].astype(str).tolist()
+    return [str(i) for i in range(len(df))]
+
+def open_shard(path, shape):
+    if os.path.exists(path):
+        return np.lib.format.open_memmap(path, mode='r+')
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+
+def read_records(path):
+    if not os.path.exists(path):
+        return []
+    return pd.read_csv(path, dtype={'row_id': str}, keep_default_na=False).to_dict('records')
+
+def check_config(config_dir, config):
+    """
+    Writes config.json of a new directory, raises ValueError if an existing one was built with other settings.
+    """
+    path = os.path.join(config_dir, 'config.json')
+    if not os.path.exists(path):
+        write_atomic(path, lambda f: json.dump(config, f, indent=2))
+        return
+    with open(path, 'r', encoding='utf8') as f:
+        existing = json.load(f)
+    different = [name for name in config if existing.get(name) != config[name]]
+    if different:
+        raise ValueError(f"{config_dir} was built with " + ', '.join(f"{name}={existing.get(name)}" for name in different) +
+                         ", not " + ', '.join(f"{name}={config[name]}" for name in different) + ". Use another --out directory.")
+
+def build_config(df, out_dir, diameter, resolution, periods, shard_size, max_workers, checkpoint_every, tile_aligned, coalesce, tolerance):
+    lod = resolutions_dict[resolution]
+    config_dir = os.path.join(out_dir, f'{diameter:g}m_{resolution}')
+    os.makedirs(config_dir, exist_ok=True)
+    height, width, _, _ = get_api().get_map_shape(diameter, diameter, periods, lod)
+    check_config(config_dir, {'periods': list(periods), 'shard_size': shard_size, 'sample_shape': [len(periods), height, width, 3], 'tile_aligned': tile_aligned})
+    index_path = os.path.join(config_dir, 'index.csv')
+    errors_path = os.path.join(config_dir, 'errors.csv')
+    # Indexes of older builds also listed failed samples, they are fetched again
+    index = [{name: record[name] for name in INDEX_COLUMNS} for record in read_records(index_path) if not record.get('error')]
+    errors = read_records(errors_path)
+    done = set(record['row_id'] for record in index)
+    row_ids = get_row_ids(df)
+    todo = np.array([k for k, row_id in enumerate(row_ids) if row_id not in done], dtype=int)
+    if len(todo) == 0:
+        print(f"{config_dir}: done")
+        return
+
+    shard_shape = (shard_size, len(periods), height, width, 3)
+    sample_bytes = int(np.prod(shard_shape[1:]))
+    x, y = get_transformer().transform(df['lat'].to_numpy(dtype=float), df['lon'].to_numpy(dtype=float))
+    shards = {}
+    next_slot = max((record['shard'] * shard_size + record['offset'] + 1 for record in index), default=0)
+
+    def checkpoint():
+        for shard in shards.values():
+            shard.flush()
+        write_atomic(index_path, lambda f: pd.DataFrame(index, columns=INDEX_COLUMNS).to_csv(f, index=False))
+        write_atomic(errors_path, lambda f: pd.DataFrame(errors, columns=ERROR_COLUMNS).to_csv(f, index=False))
+
+    print(f"{config_dir}: {len(todo)} of {len(df)} samples to go")
+    started = time.time()
+    failed = 0
+    patches = iter_patches(x[todo], y[todo], diameter, lod, periods, max_workers, coalesce, tolerance, tile_aligned, ordered=False)
+    for fetched, (i, map, error) in enumerate(patches, 1):
+        k = int(todo[i])
+        if error is not None:
+            # Not indexed, so a restart fetches it again
+            errors.append({'row_id': row_ids[k], 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'error': repr(error)})
+            failed += 1
+        else:
+            shard, offset = divmod(next_slot, shard_size)
+            next_slot += 1
+            if shard not in shards:
+                shards[shard] = open_shard(os.path.join(config_dir, f'shard_{shard:05d}.npy'), shard_shape)
+            # api returns (H, W, periods, 3), samples are stored as (periods, H, W, 3)
+            shards[shard][offset] = map.transpose(2, 0, 1, 3)
+            index.append({'row_id': row_ids[k], 'shard': shard, 'offset': offset})
+            # Slots are taken in order, a shard whose last slot is written is closed to keep the number of open memmaps small
+            if offset == shard_size - 1:
+                shards.pop(shard).flush()
+        if fetched % checkpoint_every == 0 or fetched == len(todo):
+            checkpoint()
+            elapsed = time.time() - started
+            print(f"{fetched:5d}/{len(todo):5d} | {failed} failed | {fetched / elapsed:6.2f} samples/s | {fetched * sample_bytes / elapsed / 1024 ** 2:7.2f} MB/s")
+    checkpoint()
+    if failed:
+        print(f"{config_dir}: {failed} samples failed (see errors.csv), run again to retry them")
+
+def main():
+    parser = argparse.ArgumentParser(description='Download geoportal.lt patches for every location of abandoned building csv.')
+    parser.add_argument('--csv', default='../data/abandoned_building_locations.csv')
+    parser.add_argument('--out', default='../data/patches')
+    parser.add_argument('--diameter', type=float, nargs='+', default=[100.0], help='patch diameters in meters')
+    parser.add_argument('--resolution', nargs='+', default=['0.52m'], choices=list(resolutions_dict.keys()))
+    period_names = get_api().get_period_names()
+    parser.add_argument('--period', nargs='+', default=period_names, choices=period_names)
+    parser.add_argument('--shard-size', type=int, default=256, help='samples per shard file')
+    parser.add_argument('--workers', type=int, default=8, help='samples downloaded at the same time')
+    parser.add_argument('--checkpoint-every', type=int, default=32, help='samples between checkpoints')
+    parser.add_argument('--tile-aligned', action='store_true', help='assemble patches from cached service tiles')
+    parser.add_argument('--coalesce', action='store_true', help='fetch duplicate and nearby locations together')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='distance in meters under which locations are duplicates')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv, encoding='utf8')
+    os.makedirs(args.out, exist_ok=True)
+    # Settings of the last run, every sub directory keeps its own in config.json
+    write_atomic(os.path.join(args.out, 'dataset.json'), lambda f: json.dump({'csv': args.csv, 'periods': args.period, 'diameters': args.diameter, 'resolutions': args.resolution, 'shard_size': args.shard_size}, f, indent=2))
+    for diameter in args.diameter:
+        for resolution in args.resolution:
+            build_config(df, args.out, diameter, resolution, args.period, args.shard_size, args.workers, args.checkpoint_every, args.tile_aligned, args.coalesce, args.tolerance)
+
+if __name__ == '__main__':
+    main()
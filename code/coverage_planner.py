@@ -0,0 +1,247 @@
+import json
+import math
+import numpy as np
+from api_geoportal import get_params, get_tile_params, get_tile_slices, get_transformer, meaters_to_pixels
+
+# Plans downloads of irregular areas (e.g. an administrative unit). The
+# bounding box of a polygon is split into the same parts the api would
+# request (export renders, service tiles or RasterStore chunks) and only parts
+# that intersect the polygon are kept. The plan is passed back to the api as
+# coverage, which skips the other parts.
+
+# Rough encoded size of aerial imagery, bytes per pixel of one period
+ESTIMATED_BYTES_PER_PIXEL = {'png': 1.6, 'png24': 1.6, 'png32': 2.0, 'png8': 0.7, 'jpg': 0.25, 'jpeg': 0.25, 'mixed': 0.4}
+
+def read_geometry(geometry, crs = None):
+    """
+    Reads rings of a GeoJSON Polygon or MultiPolygon (also inside Feature or FeatureCollection).
+
+    Args:
+      geometry: GeoJSON dict or path to GeoJSON file.
+      crs: 'EPSG:4326' or 'EPSG:3346'. Taken from the legacy crs member, otherwise
+           coordinates that all fit in [-180, 180] are treated as EPSG:4326.
+
+    Returns:
+      List of rings as (N, 2) arrays of (x, y) in EPSG3346.
+    """
+    if isinstance(geometry, str):
+        with open(geometry, 'r', encoding='utf8') as f:
+            geometry = json.load(f)
+    if crs is None and 'crs' in geometry:
+        crs = 'EPSG:3346' if '3346' in json.dumps(geometry['crs']) else 'EPSG:4326'
+    def get_polygons(item):
+        if item['type'] == 'FeatureCollection':
+            return [polygon for feature in item['features'] for polygon in get_polygons(feature)]
+        if item['type'] == 'Feature':
+            return get_polygons(item['geometry'])
+        if item['type'] == 'Polygon':
+            return [item['coordinates']]
+        if item['type'] == 'MultiPolygon':
+            return item['coordinates']
+        raise ValueError(f"Unsupported geometry type '{item['type']}'")
+    rings = [np.asarray(ring, dtype=float)[:, :2] for polygon in get_polygons(geometry) for ring in polygon]
+    if not rings:
+        raise ValueError("Geometry has no polygons")
+    if crs is None:
+        crs = 'EPSG:4326' if all(np.abs(ring).max() <= 180 for ring in rings) else 'EPSG:3346'
+    if crs == 'EPSG:4326':
+        rings = [np.stack(get_transformer().transform(ring[:, 1], ring[:, 0]), axis=1) for ring in rings]
+    elif crs != 'EPSG:3346':
+        raise ValueError(f"Unsupported crs '{crs}'")
+    return rings
+
+def get_coverage_mask(rings, row_edges, col_edges):
+    """
+    Finds cells of a grid that intersect polygons (even-odd rule over all rings).
+
+    A cell intersects the polygons if its centre is inside or the boundary
+    passes through it. Rings and edges are in pixels of the grid, rows growing down.
+
+    Args:
+      rings: List of (N, 2) arrays of (column, row) coordinates.
+      row_edges: Increasing row coordinates of cell borders, length rows + 1.
+      col_edges: Increasing column coordinates of cell borders, length cols + 1.
+
+    Returns:
+      bool array of shape (rows, cols).
+    """
+    row_edges = np.asarray(row_edges, dtype=float)
+    col_edges = np.asarray(col_edges, dtype=float)
+    rows, cols = len(row_edges) - 1, len(col_edges) - 1
+    starts = np.concatenate(rings)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    mask = np.zeros((rows, cols), dtype=bool)
+
+    # Cell centres inside the polygons, one scanline per row of cells
+    centre_cols = (col_edges[:-1] + col_edges[1:]) / 2
+    for row in range(rows):
+        centre = (row_edges[row] + row_edges[row + 1]) / 2
+        crossing = (starts[:, 1] > centre) != (ends[:, 1] > centre)
+        s, e = starts[crossing], ends[crossing]
+        xs = np.sort(s[:, 0] + (centre - s[:, 1]) * (e[:, 0] - s[:, 0]) / (e[:, 1] - s[:, 1]))
+        mask[row] = np.searchsorted(xs, centre_cols) % 2 == 1
+
+    # Cells the boundary passes through: cells of vertices and cells on both
+    # sides of every point where an edge crosses a grid line
+    def get_cells(values, edges):
+        cells = np.searchsorted(edges, values, side='right') - 1
+        # Points on the last border belong to the last cell
+        cells[values == edges[-1]] = len(edges) - 2
+        return cells
+    def mark(row, col):
+        valid = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+        mask[row[valid], col[valid]] = True
+    mark(get_cells(starts[:, 1], row_edges), get_cells(starts[:, 0], col_edges))
+    for axis, edges, other_edges in ((0, col_edges, row_edges), (1, row_edges, col_edges)):
+        low = np.minimum(starts[:, axis], ends[:, axis])
+        high = np.maximum(starts[:, axis], ends[:, axis])
+        first = np.searchsorted(edges, low, side='right')
+        counts = np.maximum(np.searchsorted(edges, high, side='left') - first, 0)
+        edge = np.repeat(np.arange(len(starts)), counts)
+        line = first[edge] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        t = (edges[line] - starts[edge, axis]) / (ends[edge, axis] - starts[edge, axis])
+        other_cells = get_cells(starts[edge, 1 - axis] + t * (ends[edge, 1 - axis] - starts[edge, 1 - axis]), other_edges)
+        for cells in (line - 1, line):
+            if axis == 0:
+                mark(other_cells, cells)
+            else:
+                mark(cells, other_cells)
+    return mask
+
+def get_morton_order(rows, cols):
+    """
+    Returns order of cells along the Z-order curve, so consecutive cells are close to each other.
+    """
+    rows = np.asarray(rows, dtype=np.uint64)
+    cols = np.asarray(cols, dtype=np.uint64)
+    key = np.zeros(len(rows), dtype=np.uint64)
+    for bit in range(32):
+        bit = np.uint64(bit)
+        key |= ((rows >> bit) & np.uint64(1)) << (np.uint64(2) * bit + np.uint64(1))
+        key |= ((cols >> bit) & np.uint64(1)) << (np.uint64(2) * bit)
+    return np.argsort(key, kind='stable')
+
+def get_edges(params):
+    """
+    Returns pixel borders of rows and columns of params (see get_tile_slices).
+    """
+    slices = [tile_slice for tile_slice, _ in get_tile_slices(params)]
+    cols = len(params[0])
+    row_edges = [0] + [slices[i * cols][0].stop for i in range(len(params))]
+    col_edges = [0] + [slices[j][1].stop for j in range(cols)]
+    return row_edges, col_edges
+
+class CoveragePlan:
+  """
+  Parts of the bounding box mosaic of a polygon that intersect the polygon.
+
+  kind is 'export' (export renders, see get_params), 'tile' (service tiles,
+  see get_tile_params) or 'chunk' (RasterStore chunks of download_to_store).
+  params are the parts in rows top to bottom like the api plans them, mask
+  marks the kept ones and order lists kept (row, col) in Z-order.
+  """
+  def __init__(self, kind, x, y, width, height, period, lod, tile_aligned, params, mask, chunk_size, requests_per_part, bytes_per_pixel):
+      self.kind = kind
+      self.x = x
+      self.y = y
+      self.width = width
+      self.height = height
+      self.period = list(period)
+      self.lod = lod
+      self.tile_aligned = tile_aligned
+      self.params = params
+      self.mask = mask
+      self.chunk_size = chunk_size
+      self.requests_per_part = requests_per_part
+      self.bytes_per_pixel = bytes_per_pixel
+      rows, cols = np.nonzero(mask)
+      order = get_morton_order(rows, cols)
+      self.order = list(zip(rows[order].tolist(), cols[order].tolist()))
+
+  def get_part_pixels(self):
+      sizes = [[tuple(map(int, param['size'].split(','))) for param in x_params] for x_params in self.params]
+      return np.array([[width * height for width, height in row] for row in sizes], dtype=np.int64)
+
+  def get_summary(self):
+      """
+      Returns part, request, pixel and byte counts of the plan, known before anything is downloaded.
+      """
+      pixels = self.get_part_pixels()
+      kept_pixels = int(pixels[self.mask].sum()) * len(self.period)
+      return {
+          'kind': self.kind,
+          'parts': int(self.mask.size),
+          'parts_kept': int(self.mask.sum()),
+          'kept_fraction': float(self.mask.sum() / self.mask.size),
+          'requests': int(self.requests_per_part[self.mask].sum()) * len(self.period),
+          'requests_bounding_box': int(self.requests_per_part.sum()) * len(self.period),
+          'pixels': kept_pixels,
+          'estimated_bytes': int(kept_pixels * self.bytes_per_pixel)
+      }
+
+def plan_coverage(api, geometry, period, lod, tile_aligned = False, chunk_size = None, crs = None, bytes_per_pixel = None):
+    """
+    Plans download of the parts of a polygon's bounding box that the polygon covers.
+
+    Example:
+    >>> plan = plan_coverage(get_api(), 'vilnius.geojson', ['2021-2023'], 10, tile_aligned=True)
+    >>> plan.get_summary()
+    >>> map, _ = get_api().get_map_from_plan(plan)
+
+    Args:
+      api: GeoportalAPI.
+      geometry: GeoJSON dict or file with Polygon or MultiPolygon, see read_geometry.
+      period: List of periods.
+      lod: Level of detail.
+      tile_aligned: Plan service tiles instead of export renders.
+      chunk_size: Plan RasterStore chunks of chunk_size pixels for download_to_store instead.
+      crs: 'EPSG:4326' or 'EPSG:3346', detected if None.
+      bytes_per_pixel: Encoded bytes per pixel for the estimate, by image format if None
+                       (GeoportalAPI.measure_image_formats measures it for a sample area).
+
+    Returns:
+      CoveragePlan.
+    """
+    rings = read_geometry(geometry, crs)
+    points = np.concatenate(rings)
+    x, y = points.min(axis=0)
+    width, height = points.max(axis=0) - (x, y)
+    x, y, width, height = float(x), float(y), float(width), float(height)
+    grid_info = api.get_grid_info(period, lod)
+    resolution = grid_info['resolution']
+    tile_info = grid_info['tileInfo']
+
+    def plan_parts(x, y, width, height):
+        if tile_aligned:
+            params, dims, _ = get_tile_params(x, y, width, height, resolution, tile_info)
+            left = math.floor(round((x - tile_info['origin']['x']) / resolution, 6))
+            top = math.floor(round((tile_info['origin']['y'] - (y + height)) / resolution, 6))
+            return params, dims, tile_info['origin']['x'] + left * resolution, tile_info['origin']['y'] - top * resolution
+        params, dims, _ = get_params(x, y, width, height, resolution, grid_info['maxImageWidth'], grid_info['maxImageHeight'], grid_info['scale'], api.image_format)
+        return params[::-1], dims, x, y + height
+
+    if chunk_size is None:
+        kind = 'tile' if tile_aligned else 'export'
+        params, _, x_left, y_top = plan_parts(x, y, width, height)
+        requests_per_part = np.ones((len(params), len(params[0])), dtype=np.int64)
+    else:
+        # Same chunks as download_to_store, every chunk is requested as a mosaic of its own
+        kind = 'chunk'
+        x_left, y_top = x, y + height
+        height_px, width_px = meaters_to_pixels(height, resolution), meaters_to_pixels(width, resolution)
+        params = [[{'row': row, 'col': col, 'size': f'{min(chunk_size, width_px - left)},{min(chunk_size, height_px - top)}'}
+                   for col, left in enumerate(range(0, width_px, chunk_size))]
+                  for row, top in enumerate(range(0, height_px, chunk_size))]
+        requests_per_part = np.zeros((len(params), len(params[0])), dtype=np.int64)
+        for (rows, cols), param in get_tile_slices(params):
+            _, dims, _, _ = plan_parts(x + cols.start * resolution, y_top - rows.stop * resolution,
+                                       (cols.stop - cols.start) * resolution, (rows.stop - rows.start) * resolution)
+            requests_per_part[param['row'], param['col']] = dims[0] * dims[1]
+
+    pixel_rings = [np.stack([(ring[:, 0] - x_left) / resolution, (y_top - ring[:, 1]) / resolution], axis=1) for ring in rings]
+    row_edges, col_edges = get_edges(params)
+    mask = get_coverage_mask(pixel_rings, row_edges, col_edges)
+    if bytes_per_pixel is None:
+        image_format = tile_info.get('format', 'png') if tile_aligned else api.image_format
+        bytes_per_pixel = ESTIMATED_BYTES_PER_PIXEL.get(str(image_format).lower(), ESTIMATED_BYTES_PER_PIXEL['png'])
+    return CoveragePlan(kind, x, y, width, height, period, lod, tile_aligned, params, mask, chunk_size, requests_per_part, bytes_per_pixel)
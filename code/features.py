@@ -0,0 +1,134 @@
+import numpy as np
+
+# Neighbourhood features of the random forest model. A sampling pattern is a
+# list of rings (count, distance, radius): count neighbours evenly spaced on a
+# circle of distance pixels around the target pixel, each one the mean of the
+# (2 * radius + 1)^2 window around it. Ring (1, 0, r) is the target pixel
+# itself (pooled over its own window).
+
+def get_offsets(pattern):
+    """
+    Expands a sampling pattern into neighbour offsets.
+
+    Args:
+      pattern: List of (count, distance, radius) rings, e.g. [(1, 0, 0), (8, 5, 1), (8, 20, 3)].
+
+    Returns:
+      int array of shape (K, 3) with (row offset, column offset, pooling radius) of every neighbour.
+    """
+    offsets = []
+    for count, distance, radius in pattern:
+        angles = 2 * np.pi * np.arange(count) / count
+        rows = np.rint(-distance * np.cos(angles)).astype(int)
+        cols = np.rint(distance * np.sin(angles)).astype(int)
+        offsets += [(row, col, radius) for row, col in zip(rows, cols)]
+    return np.array(offsets, dtype=int).reshape(-1, 3)
+
+def get_feature_names(offsets, channels):
+    """
+    Returns names of feature columns in the order get_features writes them.
+    """
+    return [f'{channel}_dy{dy}_dx{dx}_r{radius}' for dy, dx, radius in offsets for channel in channels]
+
+def get_halo(offsets):
+    """
+    Returns number of pixels the furthest neighbour window reaches out of its target pixel.
+    """
+    return int(np.max(np.abs(offsets[:, :2]).max(axis=1) + offsets[:, 2])) if len(offsets) else 0
+
+def get_block_features(padded, offsets, halo, rows, cols, out = None):
+    """
+    Computes features of a block from its raster window padded by halo pixels on every side.
+
+    Returns:
+      float32 array of shape (rows * cols, K * C), out if it is given.
+    """
+    channels = padded.shape[2]
+    if out is None:
+        out = np.empty((rows * cols, len(offsets) * channels), dtype=np.float32)
+    # Neighbours are gathered contiguously and interleaved into out with one
+    # transposed copy, which is much faster than K strided copies
+    stacked = np.empty((len(offsets), rows, cols, channels), dtype=np.float32)
+    # Every radius is box filtered once over the whole padded block, so every
+    # neighbour is only a shifted slice of its box image
+    boxes = {0: padded}
+    radii = [radius for radius in np.unique(offsets[:, 2]) if radius > 0]
+    if radii:
+        # Integral image with a zero first row and column, so every window sum is 4 lookups
+        integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1, channels), dtype=np.float64)
+        np.cumsum(padded, axis=0, dtype=np.float64, out=integral[1:, 1:])
+        np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    for radius in radii:
+        size = 2 * radius + 1
+        box = integral[size:, size:] - integral[:-size, size:]
+        box -= integral[size:, :-size]
+        box += integral[:-size, :-size]
+        # box[i, j] is the mean of the window centred on padded[i + radius, j + radius]
+        boxes[radius] = (box * (1 / size ** 2)).astype(np.float32)
+    for k, (dy, dx, radius) in enumerate(offsets):
+        top, left = halo + dy - radius, halo + dx - radius
+        stacked[k] = boxes[radius][top:top + rows, left:left + cols]
+    out.reshape(rows, cols, len(offsets), channels)[...] = stacked.transpose(1, 2, 0, 3)
+    return out
+
+def iter_padded_blocks(raster, halo, block_rows):
+    """
+    Reads a raster block of rows by block of rows, padded by halo pixels of nearest edge values.
+
+    Returns:
+      Generator of (first row, last row + 1, padded window of shape (rows + 2 * halo, W + 2 * halo, C)).
+    """
+    height, width = raster.shape[:2]
+    for start in range(0, height, block_rows):
+        stop = min(start + block_rows, height)
+        top, bottom = max(start - halo, 0), min(stop + halo, height)
+        window = np.asarray(raster[top:bottom]).reshape(bottom - top, width, -1)
+        pad = ((halo - (start - top), halo - (bottom - stop)), (halo, halo), (0, 0))
+        yield start, stop, np.pad(window, pad, mode='edge') if halo else window
+
+def iter_feature_blocks(raster, offsets, block_rows = 256):
+    """
+    Computes features of a raster block of rows by block of rows.
+
+    Only block_rows plus the halo needed by the furthest neighbour are read at
+    a time, so raster can be a memory mapped array larger than memory. Pixels
+    outside the raster take the value of the nearest edge pixel.
+
+    Args:
+      raster: Array of shape (H, W) or (H, W, ...), trailing axes are flattened into channels.
+      offsets: Neighbour offsets from get_offsets.
+      block_rows: Raster rows per block.
+
+    Returns:
+      Generator of (first row, float32 features of shape (block rows * W, K * C)).
+    """
+    offsets = np.asarray(offsets, dtype=int).reshape(-1, 3)
+    halo = get_halo(offsets)
+    for start, stop, padded in iter_padded_blocks(raster, halo, block_rows):
+        yield start, get_block_features(padded, offsets, halo, stop - start, raster.shape[1])
+
+def get_features(raster, pattern, block_rows = 256, out = None):
+    """
+    Builds the feature matrix of every raster pixel for the random forest model.
+
+    Example:
+    >>> X = get_features(raster, [(1, 0, 0), (8, 5, 1), (8, 20, 3)])
+
+    Args:
+      raster: Array of shape (H, W) or (H, W, ...), e.g. a RasterStore window or np.load(..., mmap_mode='r').
+      pattern: List of (count, distance, radius) rings, see get_offsets.
+      block_rows: Raster rows processed at a time, bounds memory use.
+      out: Optional float32 array (or memmap) of shape (H * W, K * C) to write into.
+
+    Returns:
+      float32 array of shape (H * W, K * C), pixels in row major order.
+    """
+    offsets = get_offsets(pattern)
+    height, width = raster.shape[:2]
+    channels = int(np.prod(raster.shape[2:], dtype=np.int64))
+    if out is None:
+        out = np.empty((height * width, len(offsets) * channels), dtype=np.float32)
+    halo = get_halo(offsets)
+    for start, stop, padded in iter_padded_blocks(raster, halo, block_rows):
+        get_block_features(padded, offsets, halo, stop - start, width, out[start * width:stop * width])
+    return out
@@ -0,0 +1,27 @@
+import os
+import tempfile
+
+def write_atomic(path, write, mode = 'w'):
+    """
+    Writes a file through a temporary file in the same directory that replaces path at the end.
+
+    Readers see either the old or the new file, never a half written one.
+
+    Args:
+      path: File to write.
+      write: Function of the open file object that writes the content.
+      mode: 'w' for utf8 text (newlines are not translated, as csv writers expect) or 'wb' for bytes.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        if 'b' in mode:
+            f = os.fdopen(fd, mode)
+        else:
+            f = os.fdopen(fd, mode, encoding='utf8', newline='')
+        with f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
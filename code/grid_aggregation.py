@@ -0,0 +1,204 @@
+import math
+import numpy as np
+import pandas as pd
+from api_geoportal import ordered_concurrent_map
+
+# Reduces imagery pixels to a coarse target grid (e.g. the 100 m population
+# grid) without keeping the full resolution mosaic. Every pixel goes to the
+# cell its centre falls into, tiles only touch the accumulators of the cells
+# they cover.
+
+class GridAggregator:
+  """
+  Per cell statistics of imagery on a regular EPSG:3346 grid, updated tile by tile.
+
+  Keeps pixel count, sum and sum of squares of every trailing index (e.g. every
+  (period, channel) of (H, W, periods, 3) tiles), so mean and std are exact.
+  For uint8 tiles it can also keep a histogram of bins bins per cell for
+  percentiles (exact with bins = 256) and count pixels of colour classes, given
+  as {name: (low RGB, high RGB)} inclusive boxes on the last axis, e.g.
+  {'red_roof': ((120, 40, 30), (220, 120, 100))}.
+  """
+  def __init__(self, x_left, y_top, cell_size, rows, cols, percentiles = None, bins = 64, classes = None):
+      self.x_left = x_left
+      self.y_top = y_top
+      self.cell_size = cell_size
+      self.rows = rows
+      self.cols = cols
+      self.percentiles = list(percentiles) if percentiles is not None else []
+      self.bins = bins
+      self.classes = dict(classes) if classes is not None else {}
+      self.count = np.zeros((rows, cols), dtype=np.int64)
+      self.sum = None
+      self.sum2 = None
+      self.histogram = None
+      self.class_count = None
+
+  @classmethod
+  def for_area(cls, x, y, width, height, cell_size, percentiles = None, bins = 64, classes = None):
+      """
+      Creates aggregator over the cells of a grid aligned to multiples of cell_size that cover an area.
+
+      Args:
+        x: x coordinate of bottom left corner in EPSG3346.
+        y: y coordinate of bottom left corner in EPSG3346.
+        width: Width of area in meters.
+        height: Height of area in meters.
+        cell_size: Cell side in meters, e.g. 100 for 1 hectare cells.
+      """
+      x_left = math.floor(x / cell_size) * cell_size
+      y_top = math.ceil((y + height) / cell_size) * cell_size
+      cols = math.ceil((x + width - x_left) / cell_size)
+      rows = math.ceil((y_top - y) / cell_size)
+      return cls(x_left, y_top, cell_size, rows, cols, percentiles, bins, classes)
+
+  def __allocate(self, tile):
+      channels = int(np.prod(tile.shape[2:], dtype=np.int64))
+      self.sum = np.zeros((self.rows, self.cols, channels), dtype=np.float64)
+      self.sum2 = np.zeros((self.rows, self.cols, channels), dtype=np.float64)
+      if self.percentiles:
+          self.histogram = np.zeros((self.rows, self.cols, channels, self.bins), dtype=np.uint32)
+      if self.classes:
+          self.class_count = np.zeros((self.rows, self.cols, channels // 3, len(self.classes)), dtype=np.int64)
+
+  def update(self, tile, x_left, y_top, resolution):
+      """
+      Adds pixels of a tile whose top left corner is at (x_left, y_top) in EPSG3346.
+      """
+      if (self.percentiles or self.classes) and tile.dtype != np.uint8:
+          raise ValueError(f"Percentiles and classes need uint8 tiles, got {tile.dtype}")
+      if self.sum is None:
+          self.__allocate(tile)
+      rows = np.floor((self.y_top - y_top + (np.arange(tile.shape[0]) + 0.5) * resolution) / self.cell_size).astype(np.int64)
+      cols = np.floor((x_left - self.x_left + (np.arange(tile.shape[1]) + 0.5) * resolution) / self.cell_size).astype(np.int64)
+      # Cell indices are monotonic, so the pixels inside the grid are one window of the tile
+      inside_rows = np.flatnonzero((rows >= 0) & (rows < self.rows))
+      inside_cols = np.flatnonzero((cols >= 0) & (cols < self.cols))
+      if len(inside_rows) == 0 or len(inside_cols) == 0:
+          return
+      rows = rows[inside_rows[0]:inside_rows[-1] + 1]
+      cols = cols[inside_cols[0]:inside_cols[-1] + 1]
+      tile = tile[inside_rows[0]:inside_rows[-1] + 1, inside_cols[0]:inside_cols[-1] + 1]
+      values = tile.reshape(tile.shape[0] * tile.shape[1], -1)
+
+      # Cells are numbered inside the block of cells the tile covers, so bincount stays small
+      r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+      block = (r1 - r0, c1 - c0)
+      cells = ((rows - r0)[:, np.newaxis] * block[1] + (cols - c0)).ravel()
+      n = block[0] * block[1]
+      self.count[r0:r1, c0:c1] += np.bincount(cells, minlength=n).reshape(block)
+      channels = values.shape[1]
+      for c in range(channels):
+          channel = values[:, c].astype(np.float64)
+          self.sum[r0:r1, c0:c1, c] += np.bincount(cells, weights=channel, minlength=n).reshape(block)
+          self.sum2[r0:r1, c0:c1, c] += np.bincount(cells, weights=channel * channel, minlength=n).reshape(block)
+          if self.histogram is not None:
+              index = cells * self.bins + values[:, c].astype(np.intp) * self.bins // 256
+              self.histogram[r0:r1, c0:c1, c] += np.bincount(index, minlength=n * self.bins).reshape(block + (self.bins,)).astype(np.uint32)
+      if self.class_count is not None:
+          rgb = values.reshape(len(cells), -1, 3)
+          for k, (low, high) in enumerate(self.classes.values()):
+              mask = np.all((rgb >= np.asarray(low)) & (rgb <= np.asarray(high)), axis=-1)
+              for p in range(rgb.shape[1]):
+                  self.class_count[r0:r1, c0:c1, p, k] += np.bincount(cells, weights=mask[:, p], minlength=n).reshape(block).astype(np.int64)
+
+  def get_mean(self):
+      with np.errstate(invalid='ignore', divide='ignore'):
+          return self.sum / self.count[..., np.newaxis]
+
+  def get_std(self):
+      mean = self.get_mean()
+      with np.errstate(invalid='ignore', divide='ignore'):
+          return np.sqrt(np.maximum(self.sum2 / self.count[..., np.newaxis] - mean ** 2, 0))
+
+  def get_percentiles(self):
+      """
+      Returns array (rows, cols, channels, len(percentiles)) of values at the centres of histogram bins.
+      """
+      cdf = np.cumsum(self.histogram, axis=-1, dtype=np.int64)
+      total = cdf[..., -1:]
+      width = 256 / self.bins
+      result = np.empty(self.histogram.shape[:-1] + (len(self.percentiles),), dtype=np.float32)
+      for k, q in enumerate(self.percentiles):
+          bin = np.argmax(cdf >= np.maximum(total * q / 100, 1), axis=-1)
+          result[..., k] = (bin + 0.5) * width - 0.5 if self.bins != 256 else bin
+      result[self.count == 0] = np.nan
+      return result
+
+  def get_class_fractions(self):
+      """
+      Returns array (rows, cols, periods, classes) of pixel fractions of every colour class.
+      """
+      with np.errstate(invalid='ignore', divide='ignore'):
+          return self.class_count / self.count[..., np.newaxis, np.newaxis]
+
+  def get_cell_centres(self):
+      x = self.x_left + (np.arange(self.cols) + 0.5) * self.cell_size
+      y = self.y_top - (np.arange(self.rows) + 0.5) * self.cell_size
+      return np.meshgrid(x, y)
+
+  def to_frame(self, channel_names = None, period_names = None):
+      """
+      Returns table with one row per cell: row, col, cell centre x and y, pixel count and statistics.
+
+      Args:
+        channel_names: Names of trailing indices, e.g. ['2021-2023_r', '2021-2023_g', ...]. Indices by default.
+        period_names: Names of periods of class fractions. Indices by default.
+      """
+      if channel_names is None: channel_names = [str(c) for c in range(self.sum.shape[2])]
+      rows, cols = np.meshgrid(np.arange(self.rows), np.arange(self.cols), indexing='ij')
+      x, y = self.get_cell_centres()
+      columns = {'row': rows.ravel(), 'col': cols.ravel(), 'x': x.ravel(), 'y': y.ravel(), 'count': self.count.ravel()}
+      mean, std = self.get_mean(), self.get_std()
+      for c, name in enumerate(channel_names):
+          columns[f'mean_{name}'] = mean[..., c].ravel()
+          columns[f'std_{name}'] = std[..., c].ravel()
+      if self.histogram is not None:
+          percentiles = self.get_percentiles()
+          for c, name in enumerate(channel_names):
+              for k, q in enumerate(self.percentiles):
+                  columns[f'p{q:g}_{name}'] = percentiles[..., c, k].ravel()
+      if self.class_count is not None:
+          fractions = self.get_class_fractions()
+          if period_names is None: period_names = [str(p) for p in range(fractions.shape[2])]
+          for p, period in enumerate(period_names):
+              for k, class_name in enumerate(self.classes):
+                  columns[f'{class_name}_{period}'] = fractions[..., p, k].ravel()
+      return pd.DataFrame(columns)
+
+
+def aggregate_store(store, aggregator):
+    """
+    Feeds every chunk of a RasterStore into aggregator, one memory mapped chunk at a time.
+    """
+    x_left, resolution, _, y_top, _, _ = store.transform
+    for row in range(store.get_chunk_dims()[0]):
+        for col in range(store.get_chunk_dims()[1]):
+            chunk = store.read_chunk(row, col)
+            if chunk is None:
+                continue
+            top, _, left, _ = store.get_chunk_window(row, col)
+            aggregator.update(chunk, x_left + left * resolution, y_top - top * resolution, resolution)
+    return aggregator
+
+def aggregate_area(api, aggregator, x, y, width, height, period, lod, chunk_size = 1024, max_workers = None, tile_aligned = False):
+    """
+    Downloads area chunk by chunk (like GeoportalAPI.download_to_store) and feeds
+    the uint8 chunks into aggregator without storing them. Up to two chunks are
+    downloaded while the previous one is aggregated, so at most three chunks are in memory.
+
+    Example:
+    >>> aggregator = GridAggregator.for_area(x, y, 5000, 5000, 100, percentiles=[10, 50, 90])
+    >>> df = aggregate_area(get_api(), aggregator, x, y, 5000, 5000, ['2021-2023'], 10).to_frame()
+    """
+    resolution = api.get_grid_info(period, lod)['resolution']
+    height_pixels, width_pixels = api.get_map_shape(width, height, period, lod)[:2]
+    windows = [(top, min(top + chunk_size, height_pixels), left, min(left + chunk_size, width_pixels))
+               for top in range(0, height_pixels, chunk_size) for left in range(0, width_pixels, chunk_size)]
+    def fetch(window):
+        top, bottom, left, right = window
+        chunk, _ = api.get_map_from_bottom_left_corner(x + left * resolution, y + height - bottom * resolution, (right - left) * resolution, (bottom - top) * resolution, period, lod, False, max_workers, tile_aligned)
+        return window, chunk
+    for (top, _, left, _), chunk in ordered_concurrent_map(fetch, windows, 2):
+        aggregator.update(chunk, x + left * resolution, y + height - top * resolution, resolution)
+    return aggregator
@@ -1,8 +1,11 @@
-import requests
-from bs4 import BeautifulSoup
+import http_session
+import os
 import json
-import re
+import hashlib
+import argparse
 import pandas as pd
+from file_utils import write_atomic
+from concurrent.futures import ThreadPoolExecutor
 
 # Data from https://www.facebook.com/legacy/notes/642765649176985/
 
@@ -40,73 +43,187 @@ def niekonaujo2dict_array(json, source):
     res = [loc for country in countries for loc in niekonaujo_country2dict_array(country, dict)]
     return res
 
+PAGE_DATA_START = 'var _pageData = "'
+
+SOURCES = {
+    'niekonaujo': "https://www.google.com/maps/d/u/0/viewer?mid=1Az6PkPxpnUrXqQ83ncNQoSZa-L8&femb=1&ll=49.210260177154%2C33.579373950000004&z=4",
+    'fb1': "https://www.google.com/maps/d/u/0/viewer?mid=1DMNV0VkWoFpwcVnkXqq_7V9lRpA&ll=55.54977308818169%2C24.37769785000001&z=7",
+    'dvarai': "https://www.google.com/maps/d/u/0/viewer?mid=1afR3M4lZZ5sN7Ec1dLWHegPbNr8&ll=54.88931537260346%2C24.868004851562517&z=6",
+    'dvarai2': "https://www.google.com/maps/d/u/0/viewer?mid=1RlEBzmmFiJ4otBtYCyZlpD9MjDY&ll=55.310687910343795%2C24.112769000000007&z=8",
+    'vaiduokliai': "https://www.google.com/maps/d/u/0/viewer?mid=1XcX902WI2qr5hMlK3WrnRMGbot0&ll=54.98112933981097%2C23.232513949999998&z=7",
+    'truristo': "https://www.google.com/maps/d/u/0/viewer?hl=lt&mid=1vASPNoEr2e_tSdsp0tmc1noJOMI&ll=55.39936060694531%2C22.756247070221&z=7",
+    'moltovolinija': "https://www.google.com/maps/d/u/0/viewer?msa=0&hl=lt&ie=UTF8&ll=54.95971420174872%2C22.390059000000004&spn=1.973305%2C2.673042&t=h&source=embed&mid=1q7QBoVtlB844rF4k_2LS93kc_Hs&z=8"
+}
+
+def scan_page_data(chunks):
+    """
+    Finds the _pageData string literal in a stream of html text chunks.
+
+    Chunks are scanned as they arrive, no DOM is built and the rest of the page
+    is not read once the closing quote is found.
+
+    :return: escaped content of the literal or None if page has no _pageData
+    """
+    buffer = ''
+    body = None
+    position = 0
+    for chunk in chunks:
+        if body is None:
+            buffer += chunk
+            start = buffer.find(PAGE_DATA_START)
+            if start < 0:
+                # Marker may be split between chunks
+                buffer = buffer[-len(PAGE_DATA_START):]
+                continue
+            body = buffer[start + len(PAGE_DATA_START):]
+        else:
+            body += chunk
+        while True:
+            end = body.find('"', position)
+            if end < 0:
+                position = len(body)
+                break
+            backslash = end
+            while backslash > 0 and body[backslash - 1] == '\\':
+                backslash -= 1
+            if (end - backslash) % 2 == 0:
+                return body[:end]
+            position = end + 1
+    return None
+
+def parse_page_data(page_data):
+    return json.loads(unescape(page_data))
+
 def niekonaujo_url2json(url):
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    script_tag = soup.find('script', string=re.compile('var _pageData'))
-    script_content = script_tag.string
-    page_data = re.search(r'var \_pageData = "(.+?)(?<!\\)";', script_content).group(1)
-    page_data = unescape(page_data)
-    page_data = json.loads(page_data)
-    return page_data
+    response = http_session.get(url, stream=True)
+    response.raise_for_status()
+    response.encoding = response.encoding or 'utf-8'
+    with response:
+        page_data = scan_page_data(response.iter_content(chunk_size=65536, decode_unicode=True))
+    return parse_page_data(page_data)
+
+def get_source_as_pd(source):
+    locs = niekonaujo2dict_array(niekonaujo_url2json(SOURCES[source]), source)
+    return pd.DataFrame(locs)
 
 def get_niekonaujo_as_pd():
-    url = "https://www.google.com/maps/d/u/0/viewer?mid=1Az6PkPxpnUrXqQ83ncNQoSZa-L8&femb=1&ll=49.210260177154%2C33.579373950000004&z=4"
-    json_data = niekonaujo_url2json(url)
-    locs = niekonaujo2dict_array(json_data, "niekonaujo")
-    df = pd.DataFrame(locs)
-    return df
+    return get_source_as_pd('niekonaujo')
 
 def get_fb1_as_pd():
-    url = "https://www.google.com/maps/d/u/0/viewer?mid=1DMNV0VkWoFpwcVnkXqq_7V9lRpA&ll=55.54977308818169%2C24.37769785000001&z=7"
-    json_data = niekonaujo_url2json(url)
-    locs = niekonaujo2dict_array(json_data, "fb1")
-    df = pd.DataFrame(locs)
-    return df
+    return get_source_as_pd('fb1')
 
 def get_dvarai_as_pd():
-    url = "https://www.google.com/maps/d/u/0/viewer?mid=1afR3M4lZZ5sN7Ec1dLWHegPbNr8&ll=54.88931537260346%2C24.868004851562517&z=6"
-    json_data = niekonaujo_url2json(url)
-    locs = niekonaujo2dict_array(json_data, "dvarai")
-    df = pd.DataFrame(locs)
-    return df
+    return get_source_as_pd('dvarai')
 
 def get_dvarai2_as_pd():
-    url = "https://www.google.com/maps/d/u/0/viewer?mid=1RlEBzmmFiJ4otBtYCyZlpD9MjDY&ll=55.310687910343795%2C24.112769000000007&z=8"
-    json_data = niekonaujo_url2json(url)
-    locs = niekonaujo2dict_array(json_data, "dvarai2")
-    df = pd.DataFrame(locs)
-    return df
+    return get_source_as_pd('dvarai2')
 
 def get_vaiduokliai_as_pd():
-    url = "https://www.google.com/maps/d/u/0/viewer?mid=1XcX902WI2qr5hMlK3WrnRMGbot0&ll=54.98112933981097%2C23.232513949999998&z=7"
-    json_data = niekonaujo_url2json(url)
-    locs = niekonaujo2dict_array(json_data, "vaiduokliai")
-    df = pd.DataFrame(locs)
-    return df
+    return get_source_as_pd('vaiduokliai')
 
 def get_truristo_as_pd():
-    url = "https://www.google.com/maps/d/u/0/viewer?hl=lt&mid=1vASPNoEr2e_tSdsp0tmc1noJOMI&ll=55.39936060694531%2C22.756247070221&z=7"
-    json_data = niekonaujo_url2json(url)
-    locs = niekonaujo2dict_array(json_data, "truristo")
-    df = pd.DataFrame(locs)
-    return df
+    return get_source_as_pd('truristo')
 
 def get_moltovolinija_as_pd():
-    url = "https://www.google.com/maps/d/u/0/viewer?msa=0&hl=lt&ie=UTF8&ll=54.95971420174872%2C22.390059000000004&spn=1.973305%2C2.673042&t=h&source=embed&mid=1q7QBoVtlB844rF4k_2LS93kc_Hs&z=8"
-    json_data = niekonaujo_url2json(url)
-    locs = niekonaujo2dict_array(json_data, "moltovolinija")
-    df = pd.DataFrame(locs)
+    return get_source_as_pd('moltovolinija')
+
+def get_row_ids(df):
+    """
+    Returns stable ids of locations: hash of source, name and coordinates
+    rounded to about 1 m. Repeated locations of one source get a #k suffix.
+    """
+    keys = [f'{source}|{name}|{lat:.5f}|{lon:.5f}' for source, name, lat, lon in zip(df['source'], df['name'], df['lat'].astype(float), df['lon'].astype(float))]
+    ids = [hashlib.sha1(key.encode('utf8')).hexdigest()[:16] for key in keys]
+    seen = {}
+    for i, row_id in enumerate(ids):
+        seen[row_id] = seen.get(row_id, -1) + 1
+        if seen[row_id]:
+            ids[i] = f'{row_id}#{seen[row_id]}'
+    return ids
+
+def fetch_source(source, state):
+    """
+    Downloads a source unless it did not change since the state was saved.
+
+    The request is conditional (ETag / Last-Modified), and sources whose
+    _pageData hashes the same as before are reported unchanged too.
+
+    :return: (DataFrame or None if unchanged, new state of source)
+    """
+    headers = {}
+    if state.get('etag'): headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'): headers['If-Modified-Since'] = state['last_modified']
+    response = http_session.get(SOURCES[source], headers=headers, stream=True)
+    with response:
+        if response.status_code == 304:
+            return None, state
+        response.raise_for_status()
+        response.encoding = response.encoding or 'utf-8'
+        page_data = scan_page_data(response.iter_content(chunk_size=65536, decode_unicode=True))
+    if page_data is None:
+        raise ValueError(f"Source '{source}' has no _pageData")
+    new_state = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'hash': hashlib.sha256(page_data.encode('utf8')).hexdigest()
+    }
+    if new_state['hash'] == state.get('hash'):
+        return None, new_state
+    return pd.DataFrame(niekonaujo2dict_array(parse_page_data(page_data), source)), new_state
+
+def refresh(csv_path, state_path, sources = None, max_workers = 8):
+    """
+    Updates the location csv with the sources that changed since the last refresh.
+
+    Sources are fetched concurrently. Rows of unchanged sources are kept as
+    they are, rows of changed sources are matched by id (see get_row_ids):
+    kept rows stay in place, removed rows are dropped and new rows are
+    appended, so ids and order of existing rows survive refreshes.
+
+    :param csv_path: location csv, created if missing
+    :param state_path: json with ETag, Last-Modified and content hash of every source
+    :param sources: names of sources to refresh, all of SOURCES by default
+
+    :return: refreshed DataFrame
+    """
+    if sources is None: sources = list(SOURCES.keys())
+    df = pd.read_csv(csv_path, encoding='utf8') if os.path.exists(csv_path) else pd.DataFrame(columns=['id', 'source', 'subsource', 'name', 'desc', 'lat', 'lon'])
+    if 'id' not in df.columns:
+        df.insert(0, 'id', get_row_ids(df))
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf8') as f:
+            state = json.load(f)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(zip(sources, executor.map(lambda source: fetch_source(source, state.get(source, {})), sources)))
+
+    for source, (new, source_state) in results.items():
+        state[source] = source_state
+        if new is None:
+            print(f"{source}: unchanged")
+            continue
+        new.insert(0, 'id', get_row_ids(new))
+        old_ids = set(df.loc[df['source'] == source, 'id'])
+        new_ids = set(new['id'])
+        # Kept rows take the new values (e.g. edited description) in their old place
+        df = df[(df['source'] != source) | df['id'].isin(new_ids)].copy()
+        kept = df['source'] == source
+        df.loc[kept, new.columns] = new.set_index('id', drop=False).loc[df.loc[kept, 'id'], new.columns].to_numpy()
+        df = pd.concat([df, new[~new['id'].isin(old_ids)]], ignore_index=True)
+        print(f"{source}: {len(new_ids - old_ids)} added, {len(old_ids - new_ids)} removed, {len(new_ids & old_ids)} kept")
+
+    write_atomic(csv_path, lambda f: df.to_csv(f, index=False))
+    write_atomic(state_path, lambda f: json.dump(state, f, indent=2))
     return df
 
-if (False):
-    df = pd.concat([
-        get_niekonaujo_as_pd(),
-        get_fb1_as_pd(),
-        get_dvarai_as_pd(),
-        get_dvarai2_as_pd(),
-        get_vaiduokliai_as_pd(),
-        get_truristo_as_pd(),
-        get_moltovolinija_as_pd()
-    ], ignore_index=True)
-    df.to_csv("abandoned_building_locations.csv", index=False)
+def main():
+    parser = argparse.ArgumentParser(description='Refresh abandoned building locations from Google My Maps sources.')
+    parser.add_argument('--csv', default='../data/abandoned_building_locations.csv')
+    parser.add_argument('--state', default='../data/abandoned_building_sources.json')
+    parser.add_argument('--source', nargs='+', default=list(SOURCES.keys()), choices=list(SOURCES.keys()))
+    args = parser.parse_args()
+    refresh(args.csv, args.state, args.source)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import time
+import random
+import threading
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+
+class AdaptiveRateLimiter:
+  """
+  Token bucket whose rate adapts to the server.
+
+  Requests are not limited until the server first answers 429/503 (rate
+  None), then the rate starts at half of the rate requests were sent at.
+  From there every success raises the rate a little (additive increase),
+  every 429/503 response halves it (multiplicative decrease) and Retry-After
+  is honoured, so the request rate settles just under what the server tolerates.
+  Throttled requests sent before the last decrease were sent at the old rate,
+  they do not halve it again, so a burst of them is a single decrease.
+  """
+  def __init__(self, rate = None, min_rate = 0.5, max_rate = None, increase = 1.0, window = 1.0):
+      self.rate = rate
+      self.min_rate = min_rate
+      self.max_rate = max_rate
+      self.increase = increase
+      self.window = window
+      self.sent = deque()
+      self.tokens = 1.0
+      self.updated = time.monotonic()
+      self.blocked_until = 0.0
+      self.decreased_at = float('-inf')
+      self.lock = threading.Lock()
+
+  def acquire(self):
+      """
+      Waits until a request may be sent, returns the send time to pass to on_throttle.
+      """
+      while True:
+          with self.lock:
+              now = time.monotonic()
+              if self.rate is None:
+                  if now >= self.blocked_until:
+                      # Send times of the last window, the rate to start from after a throttle
+                      self.sent.append(now)
+                      while self.sent[0] < now - self.window:
+                          self.sent.popleft()
+                      return now
+                  wait = self.blocked_until - now
+              else:
+                  # Burst is limited to one second worth of requests
+                  self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                  self.updated = now
+                  if now >= self.blocked_until and self.tokens >= 1:
+                      self.tokens -= 1
+                      return now
+                  wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+          time.sleep(wait)
+
+  def on_success(self):
+      with self.lock:
+          if self.rate is not None:
+              # About +increase requests/s for every second of successful requests
+              self.rate = self.rate + self.increase / self.rate
+              if self.max_rate is not None:
+                  self.rate = min(self.max_rate, self.rate)
+
+  def on_throttle(self, retry_after = None, sent_at = None):
+      with self.lock:
+          now = time.monotonic()
+          if sent_at is None or sent_at >= self.decreased_at:
+              if self.rate is None:
+                  self.rate = max(1.0, len([t for t in self.sent if t >= now - self.window]) / self.window)
+                  self.sent.clear()
+                  self.updated = now
+              self.rate = max(self.min_rate, self.rate / 2)
+              self.tokens = min(self.tokens, 0.0)
+              self.decreased_at = now
+          if retry_after is not None:
+              self.blocked_until = max(self.blocked_until, now + retry_after)
+
+
+def get_retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+  """
+  Shared transport for all requests: one pooled keep-alive session,
+  retries with exponential backoff and an adaptive rate limiter per host.
+  """
+  def __init__(self, pool_size = 32, max_retries = 4, backoff = 0.5, max_backoff = 30.0, timeout = 60.0):
+      self.session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size)
+      self.session.mount('http://', adapter)
+      self.session.mount('https://', adapter)
+      self.max_retries = max_retries
+      self.backoff = backoff
+      self.max_backoff = max_backoff
+      self.timeout = timeout
+      self.limiters = {}
+      self.retries = 0
+      self.lock = threading.Lock()
+
+  def get_limiter(self, url):
+      host = urlparse(url).netloc
+      with self.lock:
+          if host not in self.limiters:
+              self.limiters[host] = AdaptiveRateLimiter()
+          return self.limiters[host]
+
+  def __sleep_before_retry(self, attempt, retry_after = None, on_retry = None):
+      with self.lock:
+          self.retries += 1
+      if on_retry is not None:
+          on_retry(attempt)
+      delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+      time.sleep(max(delay, retry_after or 0))
+
+  def get(self, url, params = None, on_retry = None, **kwargs):
+      """
+      Same as requests.get, but retries connection errors, timeouts and
+      429/5xx responses. The last response is returned even if it failed.
+      on_retry(attempt) is called before every retry.
+      """
+      kwargs.setdefault('timeout', self.timeout)
+      limiter = self.get_limiter(url)
+      for attempt in range(self.max_retries + 1):
+          sent_at = limiter.acquire()
+          try:
+              response = self.session.get(url, params=params, **kwargs)
+          except (requests.ConnectionError, requests.Timeout):
+              if attempt == self.max_retries:
+                  raise
+              self.__sleep_before_retry(attempt, on_retry=on_retry)
+              continue
+          retry_after = get_retry_after(response)
+          if response.status_code in THROTTLE_STATUSES:
+              limiter.on_throttle(retry_after, sent_at)
+          elif response.ok:
+              limiter.on_success()
+          if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+              return response
+          # Return the connection of a streamed response to the pool before retrying
+          response.close()
+          self.__sleep_before_retry(attempt, retry_after, on_retry)
+
+
+client = None
+client_lock = threading.Lock()
+
+def get_client():
+    global client
+    with client_lock:
+        if client is None:
+            client = HttpClient()
+        return client
+
+def get(url, params = None, **kwargs):
+    return get_client().get(url, params=params, **kwargs)
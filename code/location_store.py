@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from file_utils import write_atomic
+
+HEADER_NAME = 'header.json'
+# Name of the file in the store directory that names the current version
+CURRENT_NAME = 'CURRENT'
+# Replaced versions are removed once they are this old, processes that
+# opened them before the switch have long mapped their files by then
+STALE_SECONDS = 60 * 60
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class LocationStore:
+  """
+  Location csv converted to memory mapped NumPy columns.
+
+  lat and lon are float64 arrays, source is an array of codes into the
+  source list of header.json and every other column is utf8 text stored as
+  one byte blob with row offsets. A seeded permutation (the shuffled viewing
+  order) and, for every source, its rows in that order are computed once when
+  the store is built, so selecting sources and stepping through rows are
+  array lookups. Stores are opened read only, several processes can map the
+  same one.
+
+  Every build is published as a version sub directory named by the csv hash
+  and seed, and the CURRENT file (replaced atomically) points to it, so
+  several processes may build and open the same store at once.
+  """
+  def __init__(self, directory):
+      self.directory = directory
+      with open(os.path.join(directory, HEADER_NAME), 'r', encoding='utf8') as f:
+          self.header = json.load(f)
+      self.length = self.header['length']
+      self.sources = self.header['sources']
+      self.text_columns = self.header['text_columns']
+      self.lat = self.__load('lat.npy')
+      self.lon = self.__load('lon.npy')
+      self.source = self.__load('source.npy')
+      self.permutation = self.__load('permutation.npy')
+      self.rank = self.__load('rank.npy')
+      self.source_rows = {source: self.__load(f'source_{code}.npy') for code, source in enumerate(self.sources)}
+      self.text = {column: (self.__load(f'{column}.bin.npy'), self.__load(f'{column}_offsets.npy')) for column in self.text_columns}
+      self.orders = {}
+
+  def __load(self, name):
+      return np.load(os.path.join(self.directory, name), mmap_mode='r')
+
+  @staticmethod
+  def get_current(directory):
+      """
+      Returns directory of the current version of a store, None if it was never built.
+      """
+      try:
+          with open(os.path.join(directory, CURRENT_NAME), 'r', encoding='utf8') as f:
+              version = f.read().strip()
+      except FileNotFoundError:
+          return None
+      version_directory = os.path.join(directory, version)
+      return version_directory if os.path.exists(os.path.join(version_directory, HEADER_NAME)) else None
+
+  @classmethod
+  def build(cls, csv_path, directory, seed = 0):
+      """
+      Converts a location csv (source, lat, lon and text columns) into a store.
+
+      The version is written to a temporary directory and moved into place
+      before CURRENT points to it, so readers never see a half written store.
+      Builders of the same csv and seed produce the same version, the first
+      one to finish publishes it.
+      """
+      csv_sha256 = hash_file(csv_path)
+      df = pd.read_csv(csv_path, encoding='utf8')
+      sources = df['source'].unique().tolist()
+      source = np.array([sources.index(s) for s in df['source']], dtype=np.int16)
+      permutation = np.random.default_rng(seed).permutation(len(df))
+      rank = np.empty(len(df), dtype=np.int64)
+      rank[permutation] = np.arange(len(df))
+      text_columns = [column for column in df.columns if column not in ('lat', 'lon', 'source')]
+
+      os.makedirs(directory, exist_ok=True)
+      tmp_directory = tempfile.mkdtemp(dir=directory, suffix='.tmp')
+      save = lambda name, array: np.save(os.path.join(tmp_directory, name), array)
+      save('lat.npy', df['lat'].to_numpy(dtype=np.float64))
+      save('lon.npy', df['lon'].to_numpy(dtype=np.float64))
+      save('source.npy', source)
+      save('permutation.npy', permutation)
+      save('rank.npy', rank)
+      for code in range(len(sources)):
+          save(f'source_{code}.npy', permutation[source[permutation] == code])
+      for column in text_columns:
+          encoded = [('' if pd.isna(value) else str(value)).encode('utf8') for value in df[column]]
+          save(f'{column}.bin.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+          save(f'{column}_offsets.npy', np.cumsum([0] + [len(value) for value in encoded], dtype=np.int64))
+      header = {
+          'csv': os.path.abspath(csv_path),
+          'csv_sha256': csv_sha256,
+          'seed': seed,
+          'length': len(df),
+          'sources': sources,
+          'text_columns': text_columns
+      }
+      with open(os.path.join(tmp_directory, HEADER_NAME), 'w', encoding='utf8') as f:
+          json.dump(header, f, indent=2)
+
+      version = f'{csv_sha256[:16]}_{seed}'
+      version_directory = os.path.join(directory, version)
+      try:
+          os.rename(tmp_directory, version_directory)
+      except OSError:
+          # Another process published the same version first
+          if not os.path.exists(os.path.join(version_directory, HEADER_NAME)):
+              raise
+          shutil.rmtree(tmp_directory, ignore_errors=True)
+      write_atomic(os.path.join(directory, CURRENT_NAME), lambda f: f.write(version))
+      cls.remove_stale(directory)
+      return cls(version_directory)
+
+  @staticmethod
+  def remove_stale(directory):
+      """
+      Removes versions and leftovers of failed builds older than STALE_SECONDS, except the current version.
+      """
+      current = LocationStore.get_current(directory)
+      keep = {CURRENT_NAME, os.path.basename(current) if current is not None else None}
+      now = time.time()
+      for entry in os.scandir(directory):
+          if entry.name in keep:
+              continue
+          try:
+              if now - entry.stat().st_mtime < STALE_SECONDS:
+                  continue
+          except FileNotFoundError:
+              continue
+          if entry.is_dir():
+              shutil.rmtree(entry.path, ignore_errors=True)
+          else:
+              try:
+                  os.remove(entry.path)
+              except FileNotFoundError:
+                  pass
+
+  @classmethod
+  def open(cls, csv_path, directory = None, seed = 0):
+      """
+      Opens the store of a csv, building it first if it is missing or the csv changed.
+
+      Args:
+        csv_path: Location csv.
+        directory: Store directory, csv path without extension + '_store' by default.
+        seed: Seed of the viewing order.
+      """
+      if directory is None: directory = os.path.splitext(csv_path)[0] + '_store'
+      current = cls.get_current(directory)
+      if current is not None:
+          store = cls(current)
+          if store.header['seed'] == seed and store.header['csv_sha256'] == hash_file(csv_path):
+              return store
+      return cls.build(csv_path, directory, seed)
+
+  def __len__(self):
+      return self.length
+
+  def get_order(self, sources = None):
+      """
+      Returns rows of selected sources (all if none selected) in viewing order.
+
+      Orders of source selections are merged from the per source arrays once
+      and kept, so stepping through a selection is an index into this array.
+      """
+      key = frozenset(sources or ())
+      if key not in self.orders:
+          if not key:
+              order = self.permutation
+          else:
+              rows = np.concatenate([self.source_rows[source] for source in self.sources if source in key] or [np.empty(0, dtype=np.int64)])
+              order = rows[np.argsort(self.rank[rows], kind='stable')]
+          self.orders[key] = order
+      return self.orders[key]
+
+  def get_text(self, column, row):
+      blob, offsets = self.text[column]
+      return bytes(blob[offsets[row]:offsets[row + 1]]).decode('utf8')
+
+  def get_row(self, row):
+      """
+      Returns location as dict of column values.
+      """
+      values = {column: self.get_text(column, row) for column in self.text_columns}
+      values.update({'source': self.sources[self.source[row]], 'lat': float(self.lat[row]), 'lon': float(self.lon[row])})
+      return values
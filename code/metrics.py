@@ -0,0 +1,127 @@
+import json
+import time
+import threading
+from file_utils import write_atomic
+
+# Events of the GeoportalAPI hot path. Every event has a name, a value and
+# labels. Names ending with _seconds are stage timings, the others count
+# things (bytes, hits, retries, tiles):
+#   http_seconds, http_bytes          - waiting for and size of one image response
+#   cache_hits, cache_misses          - tile cache lookups
+#   http_retries                      - retried requests (see HttpClient.get on_retry)
+#   decode_seconds                    - PNG/JPEG decoding of one image
+#   standardize_seconds               - standardize_rgb of one image
+#   copy_seconds                      - copying one image into the mosaic
+#   normalize_seconds                 - normalizer update and transform of one mosaic
+#   mosaic_seconds, mosaic_pixels     - whole mosaic
+#   tiles_done                        - progress, labels mosaic id and total tiles
+# Image events are labelled with period and kind ('export' or 'tile').
+
+class Metrics:
+  """
+  Passes events to subscribers, callables of (name, value, labels).
+
+  Without subscribers enabled is False and instrumented code skips timing
+  altogether, so disabled metrics cost one attribute check per stage.
+  """
+  def __init__(self):
+      self.subscribers = []
+      self.enabled = False
+      self.lock = threading.Lock()
+
+  def subscribe(self, subscriber):
+      with self.lock:
+          self.subscribers = self.subscribers + [subscriber]
+          self.enabled = True
+      return subscriber
+
+  def unsubscribe(self, subscriber):
+      with self.lock:
+          self.subscribers = [s for s in self.subscribers if s is not subscriber]
+          self.enabled = bool(self.subscribers)
+
+  def emit(self, name, value, **labels):
+      for subscriber in self.subscribers:
+          subscriber(name, value, labels)
+
+
+class StageTotals:
+  """
+  Subscriber that sums events per name and label set.
+
+  Only labels listed in labels are kept, so high cardinality labels (e.g.
+  mosaic id) do not create a series per mosaic. get_summary tells whether a
+  job is network bound (http_seconds) or CPU bound (decode, standardize, copy).
+  """
+  def __init__(self, labels = ('period', 'kind')):
+      self.labels = labels
+      self.totals = {}
+      self.lock = threading.Lock()
+
+  def __call__(self, name, value, labels):
+      key = (name, tuple((label, str(labels[label])) for label in self.labels if label in labels))
+      with self.lock:
+          total = self.totals.get(key)
+          if total is None:
+              self.totals[key] = [value, 1]
+          else:
+              total[0] += value
+              total[1] += 1
+
+  def get_summary(self):
+      """
+      Returns dict of name -> {'sum', 'count'} over all label sets, plus cache_hit_rate.
+      """
+      summary = {}
+      with self.lock:
+          for (name, _), (total, count) in self.totals.items():
+              item = summary.setdefault(name, {'sum': 0, 'count': 0})
+              item['sum'] += total
+              item['count'] += count
+      hits = summary.get('cache_hits', {}).get('sum', 0)
+      misses = summary.get('cache_misses', {}).get('sum', 0)
+      summary['cache_hit_rate'] = hits / (hits + misses) if hits + misses else None
+      return summary
+
+  def to_prometheus(self, prefix = 'geoportal_'):
+      """
+      Returns totals in Prometheus text format, every event as a summary with _sum and _count.
+      """
+      with self.lock:
+          items = sorted((key, list(total)) for key, total in self.totals.items())
+      lines = []
+      previous = None
+      for (name, labels), (total, count) in items:
+          metric = prefix + name
+          if metric != previous:
+              lines.append(f'# TYPE {metric} summary')
+              previous = metric
+          label_text = '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}' if labels else ''
+          lines.append(f'{metric}_sum{label_text} {total}')
+          lines.append(f'{metric}_count{label_text} {count}')
+      return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self, path, prefix = 'geoportal_'):
+      """
+      Writes totals for the node exporter textfile collector. The file is
+      replaced atomically, the collector never reads a half written one.
+      """
+      text = self.to_prometheus(prefix)
+      write_atomic(path, lambda f: f.write(text))
+
+
+class JsonLinesExporter:
+  """
+  Subscriber that writes every event as one json line with its time.
+  """
+  def __init__(self, file):
+      self.file = open(file, 'a', encoding='utf8') if isinstance(file, str) else file
+      self.lock = threading.Lock()
+
+  def __call__(self, name, value, labels):
+      line = json.dumps({'time': time.time(), 'name': name, 'value': value, **labels})
+      with self.lock:
+          self.file.write(line + '\n')
+
+  def close(self):
+      self.file.close()
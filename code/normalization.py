@@ -0,0 +1,152 @@
+import json
+import numpy as np
+
+class ChannelStandardizer:
+  """
+  Standardizes a raster with statistics collected over all of it.
+
+  Mean and std are accumulated tile by tile with the parallel form of
+  Welford's algorithm, so tiles can be added while they are downloaded.
+  Statistics are reduced over the two spatial axes and kept separately for
+  every trailing index, e.g. for every (period, channel) of a (H, W, periods, 3)
+  mosaic. Like standardize_rgb, the result is ((value - mean) / std + 1) / 2.
+  """
+  def __init__(self, dtype = np.float32):
+      self.dtype = np.dtype(dtype)
+      self.count = 0
+      self.mean = None
+      self.m2 = None
+      self.frozen = False
+
+  def update(self, tile):
+      if self.frozen:
+          return
+      values = tile.reshape((-1,) + tile.shape[2:])
+      count = values.shape[0]
+      if count == 0:
+          return
+      mean = values.mean(axis=0, dtype=np.float64)
+      m2 = values.var(axis=0, dtype=np.float64) * count
+      if self.mean is None:
+          self.count, self.mean, self.m2 = count, mean, m2
+          return
+      total = self.count + count
+      delta = mean - self.mean
+      self.mean = self.mean + delta * count / total
+      self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+      self.count = total
+
+  def get_std(self):
+      return np.sqrt(self.m2 / self.count)
+
+  def freeze(self):
+      self.frozen = True
+      return self
+
+  def transform(self, array, out = None):
+      std = self.get_std()
+      std = np.where(std > 0, std, 1)
+      scale = (0.5 / std).astype(self.dtype)
+      offset = (0.5 - self.mean * 0.5 / std).astype(self.dtype)
+      if out is None:
+          out = np.empty(array.shape, dtype=self.dtype)
+      np.multiply(array, scale, out=out, casting='unsafe')
+      out += offset
+      return out
+
+  def to_dict(self):
+      return {'type': 'standardize', 'count': self.count, 'mean': self.mean.tolist(), 'm2': self.m2.tolist()}
+
+  @classmethod
+  def from_dict(cls, data, dtype = np.float32):
+      normalizer = cls(dtype)
+      normalizer.count = data['count']
+      normalizer.mean = np.array(data['mean'])
+      normalizer.m2 = np.array(data['m2'])
+      return normalizer.freeze()
+
+  def save(self, path):
+      with open(path, 'w', encoding='utf8') as f:
+          json.dump(self.to_dict(), f)
+
+  @classmethod
+  def load(cls, path, dtype = np.float32):
+      """
+      Loads saved reference statistics. Loaded normalizer is frozen, update does nothing.
+      """
+      with open(path, 'r', encoding='utf8') as f:
+          return cls.from_dict(json.load(f), dtype)
+
+
+class PercentileStretch:
+  """
+  Linear contrast stretch between low and high percentiles of a uint8 raster.
+
+  Percentiles are taken from a 256 bin histogram that is updated tile by
+  tile, which is an exact streaming quantile sketch for 8-bit imagery. Like
+  ChannelStandardizer, it keeps one histogram per trailing index and maps
+  [p_low, p_high] to [0, 1] with values outside clipped.
+  """
+  def __init__(self, low = 2, high = 98, dtype = np.float32):
+      self.low = low
+      self.high = high
+      self.dtype = np.dtype(dtype)
+      self.histogram = None
+      self.frozen = False
+
+  def update(self, tile):
+      if self.frozen:
+          return
+      if tile.dtype != np.uint8:
+          raise ValueError(f"PercentileStretch expects uint8 tiles, got {tile.dtype}")
+      slots = int(np.prod(tile.shape[2:], dtype=np.int64))
+      values = tile.reshape(-1, slots).astype(np.intp)
+      values += np.arange(slots) * 256
+      counts = np.bincount(values.ravel(), minlength=slots * 256).reshape(tile.shape[2:] + (256,))
+      if self.histogram is None:
+          self.histogram = counts
+      else:
+          self.histogram += counts
+
+  def get_percentiles(self):
+      cdf = np.cumsum(self.histogram, axis=-1)
+      total = cdf[..., -1:]
+      low = np.argmax(cdf >= total * self.low / 100, axis=-1)
+      high = np.argmax(cdf >= total * self.high / 100, axis=-1)
+      return low, high
+
+  def freeze(self):
+      self.frozen = True
+      return self
+
+  def transform(self, array, out = None):
+      low, high = self.get_percentiles()
+      scale = (1 / np.maximum(high - low, 1)).astype(self.dtype)
+      offset = (-low * scale).astype(self.dtype)
+      if out is None:
+          out = np.empty(array.shape, dtype=self.dtype)
+      np.multiply(array, scale, out=out, casting='unsafe')
+      out += offset
+      np.clip(out, 0, 1, out=out)
+      return out
+
+  def to_dict(self):
+      return {'type': 'percentile', 'low': self.low, 'high': self.high, 'histogram': self.histogram.tolist()}
+
+  @classmethod
+  def from_dict(cls, data, dtype = np.float32):
+      normalizer = cls(data['low'], data['high'], dtype)
+      normalizer.histogram = np.array(data['histogram'], dtype=np.int64)
+      return normalizer.freeze()
+
+  def save(self, path):
+      with open(path, 'w', encoding='utf8') as f:
+          json.dump(self.to_dict(), f)
+
+  @classmethod
+  def load(cls, path, dtype = np.float32):
+      """
+      Loads saved reference histogram. Loaded normalizer is frozen, update does nothing.
+      """
+      with open(path, 'r', encoding='utf8') as f:
+          return cls.from_dict(json.load(f), dtype)
@@ -0,0 +1,132 @@
+import os
+import time
+import pickle
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from raster_store import RasterStore
+from features import get_offsets, get_halo, get_features
+
+# Runs a trained model over a whole raster and writes a density map.
+#
+# The input is a RasterStore (see GeoportalAPI.download_to_store) and the
+# output is a float32 RasterStore with the same chunks and transform. Every
+# output chunk is predicted by a worker process from the input window around
+# it, extended by halo pixels on every side, and written atomically, so a
+# stopped job continues with the chunks that are still missing.
+
+class FeatureModel:
+  """
+  Adapts a pixel model (e.g. sklearn random forest) to predict_store.
+
+  Features of every window pixel are built with features.get_features from a
+  sampling pattern and passed to estimator.predict.
+  """
+  def __init__(self, estimator, pattern, block_rows = 256):
+      self.estimator = estimator
+      self.pattern = pattern
+      self.block_rows = block_rows
+      self.halo = get_halo(get_offsets(pattern))
+
+  def predict(self, window):
+      features = get_features(window, self.pattern, self.block_rows)
+      return np.asarray(self.estimator.predict(features), dtype=np.float32).reshape(window.shape[:2] + (-1,))
+
+
+def read_padded_window(store, top, bottom, left, right, halo):
+    """
+    Reads pixels [top - halo:bottom + halo, left - halo:right + halo], pixels outside the raster take the nearest edge value.
+    """
+    window = store.read_window(top - halo, bottom + halo, left - halo, right + halo)
+    pad = ((max(halo - top, 0), max(bottom + halo - store.shape[0], 0)),
+           (max(halo - left, 0), max(right + halo - store.shape[1], 0))) + ((0, 0),) * (len(store.shape) - 2)
+    return np.pad(window, pad, mode='edge') if any(before or after for before, after in pad) else window
+
+worker = {}
+
+def init_worker(model, input_dir, output_dir, halo):
+    worker['model'] = model
+    worker['input'] = RasterStore(input_dir)
+    worker['output'] = RasterStore(output_dir)
+    worker['halo'] = halo
+
+def predict_chunk(row, col):
+    output = worker['output']
+    halo = worker['halo']
+    top, bottom, left, right = output.get_chunk_window(row, col)
+    window = read_padded_window(worker['input'], top, bottom, left, right, halo)
+    prediction = np.asarray(worker['model'].predict(window))
+    # Models may return the whole window or only the chunk inside the halo
+    if prediction.shape[:2] == window.shape[:2]:
+        prediction = prediction[halo:halo + bottom - top, halo:halo + right - left]
+    output.write_chunk(row, col, prediction.reshape((bottom - top, right - left) + output.shape[2:]))
+    return row, col
+
+def predict_store(input_dir, output_dir, model, halo = None, channels = 1, processes = None):
+    """
+    Predicts every chunk of a RasterStore into a new float32 RasterStore.
+
+    Args:
+      input_dir: Directory of input RasterStore, e.g. (H, W, periods, 3) uint8 mosaic.
+      output_dir: Directory of output store, created with the chunks and transform of input.
+      model: Picklable object with predict(window), window is a chunk extended by halo pixels
+             on every side. It returns prediction for the whole window or only for the chunk.
+      halo: Pixels of context model needs around a chunk, model.halo (or 0) by default.
+      channels: Number of values model predicts per pixel, output has shape (H, W) if it is 1.
+      processes: Number of worker processes, os.cpu_count() by default.
+
+    Returns:
+      Output RasterStore.
+    """
+    if halo is None:
+        halo = getattr(model, 'halo', 0)
+    source = RasterStore(input_dir)
+    shape = source.shape[:2] + ((channels,) if channels > 1 else ())
+    output = RasterStore.create(output_dir, shape, source.chunk_shape, np.float32, source.transform, source.periods, source.lod)
+    missing = output.get_missing_chunks()
+    total = output.get_chunk_dims()[0] * output.get_chunk_dims()[1]
+    print(f"{output_dir}: {len(missing)} of {total} chunks to predict")
+    started = time.time()
+    with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(model, input_dir, output_dir, halo)) as executor:
+        futures = [executor.submit(predict_chunk, row, col) for row, col in missing]
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            print(f"{done:5d}/{len(missing):5d} | {done / (time.time() - started):6.2f} chunks/s")
+    return output
+
+def predict_area(api, directory, x, y, width, height, period, lod, model, halo = None, channels = 1, chunk_size = 1024, processes = None, max_workers = None, tile_aligned = False):
+    """
+    Downloads area from geoportal.lt into directory/input and predicts it into directory/prediction.
+
+    Both steps work chunk by chunk and skip chunks already on disk, so memory
+    stays bounded by chunk size and the job can be restarted with the same arguments.
+
+    Returns:
+      Output RasterStore.
+    """
+    api.download_to_store(os.path.join(directory, 'input'), x, y, width, height, period, lod, chunk_size, max_workers, tile_aligned)
+    return predict_store(os.path.join(directory, 'input'), os.path.join(directory, 'prediction'), model, halo, channels, processes)
+
+def main():
+    from api_geoportal import get_api, resolutions_dict
+    parser = argparse.ArgumentParser(description='Predict density map of an area with a pickled model.')
+    parser.add_argument('--model', required=True, help='pickled object with predict(window)')
+    parser.add_argument('--out', required=True, help='job directory')
+    parser.add_argument('--area', type=float, nargs=4, required=True, metavar=('X', 'Y', 'WIDTH', 'HEIGHT'), help='bottom left corner and size in meters, EPSG3346')
+    parser.add_argument('--resolution', default='0.52m', choices=list(resolutions_dict.keys()))
+    parser.add_argument('--period', nargs='+', required=True)
+    parser.add_argument('--halo', type=int, default=None, help='context pixels around every chunk')
+    parser.add_argument('--channels', type=int, default=1, help='values predicted per pixel')
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None, help='requests per download')
+    parser.add_argument('--tile-aligned', action='store_true', help='assemble input from cached service tiles')
+    args = parser.parse_args()
+
+    with open(args.model, 'rb') as f:
+        model = pickle.load(f)
+    x, y, width, height = args.area
+    predict_area(get_api(), args.out, x, y, width, height, args.period, resolutions_dict[args.resolution], model, args.halo, args.channels, args.chunk_size, args.processes, args.workers, args.tile_aligned)
+
+if __name__ == '__main__':
+    main()
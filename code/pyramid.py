@@ -0,0 +1,65 @@
+import numpy as np
+from api_geoportal import get_api, get_transformer, resolutions_dict, ordered_concurrent_map
+
+# Multi-scale input of the CNN approach: K concentric patches of the same
+# size in pixels, patch k covering patch_size * resolution_k meters.
+
+def get_pyramid(x, y, patch_size, resolutions, period, tile_aligned = True, max_workers = None, api = None):
+    """
+    Extracts concentric patches around a point at several resolutions.
+
+    Every scale is fetched at the lod of its resolution, so each patch costs
+    about patch_size * patch_size pixels no matter how wide its context is.
+    By default patches are cut from cached service tiles (see
+    GeoportalAPI.get_map_from_bottom_left_corner_generator), so coarse tiles
+    are downloaded once and reused by neighbouring points.
+
+    Args:
+      x: x coordinate of centre in EPSG3346.
+      y: y coordinate of centre in EPSG3346.
+      patch_size: Side of every patch in pixels.
+      resolutions: Resolutions from finest to coarsest, keys of resolutions_dict (e.g. ['0.52m', '2.64m', '13.22m']).
+      period: Period of map.
+      tile_aligned: Cut patches from cached service tiles instead of export renders.
+      max_workers: Number of scales fetched at the same time, all of them by default.
+      api: GeoportalAPI to use, the shared one by default.
+
+    Returns:
+      uint8 array of shape (K, patch_size, patch_size, 3).
+    """
+    if api is None: api = get_api()
+    lods = [resolutions_dict[resolution] for resolution in resolutions]
+    pyramid = np.empty((len(lods), patch_size, patch_size, 3), dtype=np.uint8)
+    def fetch(k):
+        extent = patch_size * api.get_grid_info([period], lods[k])['resolution']
+        api.get_map_from_center(x, y, extent, extent, [period], lods[k], False, 1, tile_aligned, out=pyramid[k][:, :, np.newaxis, :])
+    for _ in ordered_concurrent_map(fetch, range(len(lods)), max_workers or len(lods)):
+        pass
+    return pyramid
+
+def iter_pyramids(x, y, patch_size, resolutions, period, tile_aligned = True, max_workers = 8, api = None):
+    """
+    Extracts pyramids (see get_pyramid) for many points in EPSG3346.
+
+    Returns:
+      Generator of (index, pyramid, error) in input order. pyramid is None if error is not None.
+    """
+    if api is None: api = get_api()
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+    def fetch(i):
+        try:
+            return i, get_pyramid(x[i], y[i], patch_size, resolutions, period, tile_aligned, 1, api), None
+        except Exception as error:
+            return i, None, error
+    return ordered_concurrent_map(fetch, range(len(x)), max_workers)
+
+def get_geoportal_lt_pyramid(lat, lon, patch_size, resolutions, period):
+    """
+    Same as get_pyramid for a point given by latitude and longitude.
+
+    Example:
+    >>> pyramid = get_geoportal_lt_pyramid(54.6872, 25.2797, 64, ['0.52m', '2.64m', '13.22m'], '2021-2023')
+    """
+    x, y = get_transformer().transform(lat, lon)
+    return get_pyramid(x, y, patch_size, resolutions, period)
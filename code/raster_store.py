@@ -0,0 +1,137 @@
+import os
+import json
+import math
+import numpy as np
+from file_utils import write_atomic
+
+HEADER_NAME = 'header.json'
+
+class RasterStore:
+  """
+  Raster split into fixed size chunks, stored as a directory of .npy files.
+
+  header.json holds the raster shape, chunk shape, dtype, the affine transform
+  in EPSG:3346 ([x_left, resolution, 0, y_top, 0, -resolution]), period list
+  and lod. Chunks cover the first two axes (rows, columns) and all trailing
+  axes, they are written atomically and read back memory mapped, so a raster
+  can be filled in any order, resumed after interruption and read by windows
+  without loading it whole.
+  """
+  def __init__(self, directory):
+      self.directory = directory
+      with open(os.path.join(directory, HEADER_NAME), 'r', encoding='utf8') as f:
+          self.header = json.load(f)
+      self.shape = tuple(self.header['shape'])
+      self.chunk_shape = tuple(self.header['chunk_shape'])
+      self.dtype = np.dtype(self.header['dtype'])
+      self.transform = self.header['transform']
+      self.periods = self.header['periods']
+      self.lod = self.header['lod']
+      self.fill_value = self.header.get('fill_value', 0)
+
+  @classmethod
+  def create(cls, directory, shape, chunk_shape, dtype, transform, periods = None, lod = None, fill_value = 0):
+      """
+      Creates a new store or opens an existing one with the same layout.
+
+      Args:
+        directory: Store directory.
+        shape: Shape of the whole raster, e.g. (H, W, periods, 3).
+        chunk_shape: (rows, cols) of one chunk.
+        dtype: Data type of raster.
+        transform: [x_left, resolution, 0, y_top, 0, -resolution] in EPSG:3346.
+        periods: Period names along the period axis.
+        lod: Level of detail raster was downloaded at.
+        fill_value: Value of pixels in chunks that were never written.
+
+      Returns:
+        RasterStore.
+      """
+      header = {
+          'shape': list(shape),
+          'chunk_shape': list(chunk_shape),
+          'dtype': np.dtype(dtype).str,
+          'crs': 'EPSG:3346',
+          'transform': list(transform),
+          'periods': list(periods) if periods is not None else None,
+          'lod': lod,
+          'fill_value': fill_value
+      }
+      path = os.path.join(directory, HEADER_NAME)
+      if os.path.exists(path):
+          store = cls(directory)
+          for name in ('shape', 'chunk_shape', 'dtype', 'transform', 'periods', 'lod'):
+              if store.header[name] != header[name]:
+                  raise ValueError(f"Store in '{directory}' has different {name}: {store.header[name]} != {header[name]}")
+          return store
+      os.makedirs(directory, exist_ok=True)
+      write_atomic(path, lambda f: json.dump(header, f, indent=2))
+      return cls(directory)
+
+  def get_chunk_dims(self):
+      return (math.ceil(self.shape[0] / self.chunk_shape[0]), math.ceil(self.shape[1] / self.chunk_shape[1]))
+
+  def get_chunk_window(self, row, col):
+      top = row * self.chunk_shape[0]
+      left = col * self.chunk_shape[1]
+      return top, min(top + self.chunk_shape[0], self.shape[0]), left, min(left + self.chunk_shape[1], self.shape[1])
+
+  def __chunk_path(self, row, col):
+      return os.path.join(self.directory, f'{row}.{col}.npy')
+
+  def has_chunk(self, row, col):
+      return os.path.exists(self.__chunk_path(row, col))
+
+  def get_missing_chunks(self):
+      rows, cols = self.get_chunk_dims()
+      return [(row, col) for row in range(rows) for col in range(cols) if not self.has_chunk(row, col)]
+
+  def write_chunk(self, row, col, data):
+      top, bottom, left, right = self.get_chunk_window(row, col)
+      expected = (bottom - top, right - left) + self.shape[2:]
+      if data.shape != expected:
+          raise ValueError(f"Chunk ({row}, {col}) has shape {data.shape}, expected {expected}")
+      write_atomic(self.__chunk_path(row, col), lambda f: np.save(f, data.astype(self.dtype, copy=False)), 'wb')
+
+  def read_chunk(self, row, col):
+      """
+      Returns chunk as read only memory mapped array or None if it is missing.
+      """
+      if not self.has_chunk(row, col):
+          return None
+      return np.load(self.__chunk_path(row, col), mmap_mode='r')
+
+  def read_window(self, top, bottom, left, right):
+      """
+      Reads pixels [top:bottom, left:right] touching only the chunks they cover.
+      """
+      top, left = max(top, 0), max(left, 0)
+      bottom, right = min(bottom, self.shape[0]), min(right, self.shape[1])
+      out = np.full((max(bottom - top, 0), max(right - left, 0)) + self.shape[2:], self.fill_value, dtype=self.dtype)
+      if out.size == 0:
+          return out
+      for row in range(top // self.chunk_shape[0], (bottom - 1) // self.chunk_shape[0] + 1):
+          for col in range(left // self.chunk_shape[1], (right - 1) // self.chunk_shape[1] + 1):
+              chunk = self.read_chunk(row, col)
+              if chunk is None:
+                  continue
+              c_top, c_bottom, c_left, c_right = self.get_chunk_window(row, col)
+              r0, r1 = max(top, c_top), min(bottom, c_bottom)
+              k0, k1 = max(left, c_left), min(right, c_right)
+              out[r0 - top:r1 - top, k0 - left:k1 - left] = chunk[r0 - c_top:r1 - c_top, k0 - c_left:k1 - c_left]
+      return out
+
+  def xy_to_pixel(self, x, y):
+      """
+      Converts EPSG:3346 coordinates to (row, col) of the raster.
+      """
+      x_left, resolution, _, y_top, _, _ = self.transform
+      return math.floor((y_top - y) / resolution), math.floor((x - x_left) / resolution)
+
+  def read_window_xy(self, x, y, width, height):
+      """
+      Reads area given by bottom left corner and size in meters (EPSG:3346).
+      """
+      top, left = self.xy_to_pixel(x, y + height)
+      resolution = self.transform[1]
+      return self.read_window(top, top + math.ceil(round(height / resolution, 6)), left, left + math.ceil(round(width / resolution, 6)))
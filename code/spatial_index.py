@@ -0,0 +1,103 @@
+import numpy as np
+
+class GridIndex:
+  """
+  Grid hash of points in a projected coordinate system (EPSG:3346, meters).
+
+  Every point is put into the square cell of size cell_size it falls into, so
+  points near a location are found by looking at the 3 x 3 cells around it.
+  """
+  def __init__(self, x, y, cell_size):
+      self.x = np.asarray(x, dtype=float)
+      self.y = np.asarray(y, dtype=float)
+      self.cell_size = cell_size
+      cells_x = np.floor(self.x / cell_size).astype(np.int64)
+      cells_y = np.floor(self.y / cell_size).astype(np.int64)
+      order = np.lexsort((cells_y, cells_x))
+      keys = np.stack([cells_x[order], cells_y[order]], axis=1)
+      starts = np.flatnonzero(np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)])
+      self.cells = {(int(keys[start, 0]), int(keys[start, 1])): indices for start, indices in zip(starts, np.split(order, starts[1:]))}
+
+  def query_radius(self, x, y, radius):
+      """
+      Returns indices of points within radius meters of (x, y).
+      """
+      reach = int(np.ceil(radius / self.cell_size))
+      cell_x = int(np.floor(x / self.cell_size))
+      cell_y = int(np.floor(y / self.cell_size))
+      candidates = [self.cells[(i, j)]
+                    for i in range(cell_x - reach, cell_x + reach + 1)
+                    for j in range(cell_y - reach, cell_y + reach + 1)
+                    if (i, j) in self.cells]
+      if not candidates:
+          return np.empty(0, dtype=np.int64)
+      candidates = np.concatenate(candidates)
+      distance = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+      return np.sort(candidates[distance <= radius])
+
+def deduplicate(x, y, tolerance):
+    """
+    Finds points that lie within tolerance meters of an earlier point.
+
+    Args:
+      x: x coordinates in EPSG3346.
+      y: y coordinates in EPSG3346.
+      tolerance: Distance in meters under which points are treated as the same.
+
+    Returns:
+      Array with index of representative point for every point. Representative
+      is the first point (in input order) of the duplicates, unique points
+      represent themselves.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    representative = np.arange(len(x))
+    # Points that failed to project (inf, nan) are left unique
+    finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if tolerance <= 0 or len(finite) == 0:
+        return representative
+    index = GridIndex(x[finite], y[finite], tolerance)
+    for i in finite:
+        if representative[i] != i:
+            continue
+        for j in finite[index.query_radius(x[i], y[i], tolerance)]:
+            if j > i and representative[j] == j:
+                representative[j] = i
+    return representative
+
+def group_points(x, y, diameter, max_extent, max_overhead = 2.0):
+    """
+    Groups points whose square patches can be cut from one shared window.
+
+    Points are hashed into grid cells, so the window around the patches of a
+    group is never larger than max_extent x max_extent meters. A group is only
+    kept if its window area is at most max_overhead times the total area of its
+    patches, otherwise its points are fetched one by one.
+
+    Args:
+      x: x coordinates of patch centres in EPSG3346.
+      y: y coordinates of patch centres in EPSG3346.
+      diameter: Patch side in meters.
+      max_extent: Largest window side in meters (e.g. maxImageWidth * resolution).
+      max_overhead: Allowed ratio of window area to patch area.
+
+    Returns:
+      List of index arrays ordered by their smallest index.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    cell_size = min(max_extent - diameter, 4 * diameter)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if cell_size <= 0 or not finite.any():
+        return [np.array([i]) for i in range(len(x))]
+    groups = [np.array([i]) for i in np.flatnonzero(~finite)]
+    finite = np.flatnonzero(finite)
+    index = GridIndex(x[finite], y[finite], cell_size)
+    for indices in index.cells.values():
+        indices = finite[indices]
+        window = (np.ptp(x[indices]) + diameter) * (np.ptp(y[indices]) + diameter)
+        if len(indices) > 1 and window <= max_overhead * len(indices) * diameter ** 2:
+            groups.append(np.sort(indices))
+        else:
+            groups += [np.array([i]) for i in indices]
+    return sorted(groups, key=lambda group: group[0])
@@ -0,0 +1,140 @@
+import os
+import hashlib
+import threading
+from file_utils import write_atomic
+
+KEY_PARAMS = ('bbox', 'size', 'mapScale', 'format')
+
+class TileCache:
+  """
+  Content cache of downloaded map images stored on disk.
+
+  Entries are plain files named by the hash of their key and spread over 256
+  sub directories. Every write goes to a temporary file that is then renamed,
+  so several processes can share one cache directory. The modification time of
+  an entry is refreshed on every hit and the least recently used entries are
+  removed once the total size exceeds max_bytes. Eviction goes down to
+  low_watermark * max_bytes, so the directory is scanned once per many puts
+  instead of on every put of a full cache.
+  """
+  def __init__(self, directory, max_bytes = 1024 ** 3, low_watermark = 0.9):
+      self.directory = directory
+      self.max_bytes = max_bytes
+      self.low_watermark = low_watermark
+      self.hits = 0
+      self.misses = 0
+      self.lock = threading.Lock()
+      os.makedirs(directory, exist_ok=True)
+      self.size = sum(size for _, size, _ in self.__entries())
+
+  def key(self, url, params = None):
+      """
+      Builds cache key from url and the params that define image content.
+
+      Args:
+        url: Request url (for export requests the period service url + '/export').
+        params: Request params. Only bbox, size, mapScale and format are used.
+
+      Returns:
+        Hex digest used as the entry name.
+      """
+      parts = [url]
+      if params is not None:
+          parts += [f"{name}={params.get(name)}" for name in KEY_PARAMS]
+      return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+  def __path(self, key):
+      return os.path.join(self.directory, key[:2], key)
+
+  def get(self, key):
+      path = self.__path(key)
+      try:
+          with open(path, 'rb') as f:
+              data = f.read()
+          os.utime(path)
+      except FileNotFoundError:
+          with self.lock:
+              self.misses += 1
+          return None
+      with self.lock:
+          self.hits += 1
+      return data
+
+  def touch(self, key):
+      """
+      Marks an entry as recently used without reading it, returns False if it is not cached.
+      """
+      try:
+          os.utime(self.__path(key))
+      except FileNotFoundError:
+          return False
+      return True
+
+  def put(self, key, data):
+      path = self.__path(key)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      write_atomic(path, lambda f: f.write(data), 'wb')
+      with self.lock:
+          self.size += len(data)
+          evict = self.size > self.max_bytes
+      if evict:
+          self.evict(full_only=True)
+
+  def __entries(self):
+      for sub_dir in os.scandir(self.directory):
+          if not sub_dir.is_dir():
+              continue
+          for entry in os.scandir(sub_dir.path):
+              if entry.name.endswith('.tmp'):
+                  continue
+              try:
+                  stat = entry.stat()
+              except FileNotFoundError:
+                  continue
+              yield entry.path, stat.st_size, stat.st_mtime
+
+  def evict(self, full_only = False):
+      """
+      Removes least recently used entries until the cache fits into low_watermark * max_bytes.
+
+      The size is recounted from disk, because other processes may have
+      added or removed entries in the meantime.
+
+      Args:
+        full_only: Do nothing unless the cache is over max_bytes, e.g. when
+                   another thread has evicted since the caller checked.
+      """
+      with self.lock:
+          if full_only and self.size <= self.max_bytes:
+              return
+          entries = sorted(self.__entries(), key=lambda entry: entry[2])
+          size = sum(entry[1] for entry in entries)
+          target = self.max_bytes * self.low_watermark if size > self.max_bytes else self.max_bytes
+          for path, entry_size, _ in entries:
+              if size <= target:
+                  break
+              try:
+                  os.remove(path)
+              except FileNotFoundError:
+                  pass
+              size -= entry_size
+          self.size = size
+
+  def clear(self):
+      with self.lock:
+          for path, _, _ in list(self.__entries()):
+              try:
+                  os.remove(path)
+              except FileNotFoundError:
+                  pass
+          self.size = 0
+
+  def get_stats(self):
+      total = self.hits + self.misses
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'hit_rate': self.hits / total if total > 0 else 0.0,
+          'bytes': self.size,
+          'max_bytes': self.max_bytes
+      }